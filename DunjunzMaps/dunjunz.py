@@ -22,15 +22,11 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import sys
 import Image
 import UEFfile
+import scrambling
 
 def unscramble_data(data):
 
-    new_data = ""
-    for i in range(len(data)):
-    
-        new_data += chr(ord(data[i]) ^ (i % 256))
-    
-    return new_data
+    return scrambling.dunjunz.apply(data)
 
 
 checksums = [0x62, 0xcd, 0x0c, 0x44, 0x4d, 0x22, 0xf6, 0x42,
@@ -21,15 +21,11 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
 import UEFfile
+import scrambling
 
 def unscramble_data(data):
 
-    new_data = ""
-    for i in range(len(data)):
-    
-        new_data += chr(ord(data[i]) ^ ((i + 1) % 256))
-    
-    return new_data
+    return scrambling.icarus.apply(data)
 
 tile_map = {
  0x00: "XX",    # wall
@@ -22,15 +22,11 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import sys
 import Image
 import UEFfile
+import scrambling
 
 def unscramble_data(data):
 
-    new_data = ""
-    for i in range(len(data)):
-    
-        new_data += chr(ord(data[i]) ^ ((i + 1) % 256))
-    
-    return new_data
+    return scrambling.icarus.apply(data)
 
 
 checksums = [0xf4, 0x6f, 0xfe, 0x74, 0x83, 0x5b, 0x5f, 0x14, 0xd3, 0xdc,
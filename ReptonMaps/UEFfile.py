@@ -19,7 +19,7 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import exceptions, sys, string, os, gzip, types
+import exceptions, sys, string, os, gzip, types, mmap, struct, operator, bisect
 
 class UEFfile_error(exceptions.Exception):
 
@@ -36,21 +36,250 @@ else:
 
 version = '0.21'
 date = '2013-03-03'
+
+
+def make_crc_table():
+    """Return a lookup table for the CRC-16 (polynomial 0x1021) used by the
+    cassette filing system, indexed by the byte combined with the high byte
+    of the current CRC value."""
+
+    table = []
+
+    for i in range(256):
+
+        crc = i << 8
+
+        for j in range(8):
+
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xffff
+            else:
+                crc = (crc << 1) & 0xffff
+
+        table.append(crc)
+
+    return table
+
+crc_table = make_crc_table()
+
+
+def make_shift_table(shift, framed = False):
+    """Return a translation table which maps each byte value to the byte
+    obtained by shifting it to the right by the number of bits given, or to
+    the left if the shift is negative. If framed is True, each value is
+    first surrounded by a start bit and a stop bit."""
+
+    table = []
+
+    for i in range(256):
+
+        if framed:
+            i = (i << 1) | 0x200
+
+        if shift >= 0:
+            table.append((i >> shift) & 0xff)
+        else:
+            table.append((i << -shift) & 0xff)
+
+    return ''.join(map(chr, table))
+
+# Each group of five bytes in a 0x102 chunk holds four framed bytes. The
+# bytes of each group are combined from parts of the framed bytes, given as
+# (framed byte, shift) pairs, and vice versa.
+encode_parts = [[(0, 0)], [(0, 8), (1, -2)], [(1, 6), (2, -4)],
+                [(2, 4), (3, -6)], [(3, 2)]]
+decode_parts = [[(0, 1), (1, -7)], [(1, 3), (2, -5)], [(2, 5), (3, -3)],
+                [(3, 7), (4, -1)]]
+
+encode_tables = dict((shift, make_shift_table(shift, True))
+                     for parts in encode_parts for i, shift in parts)
+decode_tables = dict((shift, make_shift_table(shift))
+                     for parts in decode_parts for i, shift in parts)
     
     
+class ChunkIndex:
+    """chunks = ChunkIndex(data, start)
+
+    Create a sequence of (chunk ID, chunk data) tuples from a buffer, such as
+    a memory-mapped file, containing UEF chunks from the start offset given.
+    Only the ID, offset and length of each chunk are read when the index is
+    created. The chunk data is returned as a buffer object referring to the
+    original data when a chunk is accessed.
+    """
+
+    def __init__(self, data, start = 0):
+
+        self.data = data
+
+        # List of (chunk ID, offset, length) tuples
+        self.index = []
+
+        ptr = start
+        end = len(data)
+
+        while ptr + 6 <= end:
+
+            chunk_id, length = struct.unpack_from('<HI', data, ptr)
+            ptr = ptr + 6
+
+            # Truncated chunks only contain the data that is present
+            length = min(length, end - ptr)
+            self.index.append((chunk_id, ptr, length))
+            ptr = ptr + length
+
+    def __len__(self):
+
+        return len(self.index)
+
+    def __getitem__(self, i):
+
+        if type(i) == types.SliceType:
+            return map(self.__getitem__, range(*i.indices(len(self.index))))
+
+        chunk_id, offset, length = self.index[i]
+
+        if length == 0:
+            return (chunk_id, '')
+        else:
+            return (chunk_id, buffer(self.data, offset, length))
+
+    def __delitem__(self, i):
+
+        del self.index[i]
+
+    def __iter__(self):
+
+        for i in range(len(self.index)):
+            yield self[i]
+
+
+class PositionIndex:
+    """positions = PositionIndex(chunks)
+
+    Record the positions of chunks in a list of chunks, in order, so that the
+    next chunk with a given ID, the next file block and the nearest chunk
+    that is not a file block can be found without examining every chunk in
+    between.
+    """
+
+    def __init__(self, chunks = None):
+
+        self.chunks = chunks
+        self.length = 0
+
+        # Positions of chunks with each ID, of file blocks (0x100 and 0x102
+        # chunks with more than one byte of data) and of other chunks
+        self.ids = {}
+        self.blocks = []
+        self.others = []
+
+        if chunks is not None:
+            self.add(chunks)
+
+    def add(self, chunks):
+        """Record the positions of the chunks given, which follow those
+        already in the index."""
+
+        position = self.length
+
+        for chunk_id, data in chunks:
+
+            self.ids.setdefault(chunk_id, []).append(position)
+
+            if chunk_id != 0x100 and chunk_id != 0x102:
+                self.others.append(position)
+            elif len(data) > 1:
+                self.blocks.append(position)
+
+            position = position + 1
+
+        self.length = position
+
+    def copy(self, index, start, end):
+        """Record the positions of the chunks from start to end in the chunks
+        described by another index, which follow those already in the index."""
+
+        offset = self.length - start
+
+        def select(positions):
+            return map(lambda x: x + offset,
+                       positions[bisect.bisect_left(positions, start):bisect.bisect_left(positions, end)])
+
+        for chunk_id, positions in index.ids.items():
+
+            positions = select(positions)
+            if positions:
+                self.ids.setdefault(chunk_id, []).extend(positions)
+
+        self.blocks.extend(select(index.blocks))
+        self.others.extend(select(index.others))
+        self.length = self.length + end - start
+
+    def remove(self, position):
+        """Remove the chunk at the given position from the index, moving the
+        chunks that follow it."""
+
+        def remove(positions):
+            i = bisect.bisect_left(positions, position)
+            if i < len(positions) and positions[i] == position:
+                del positions[i]
+            for j in range(i, len(positions)):
+                positions[j] = positions[j] - 1
+
+        for positions in self.ids.values():
+            remove(positions)
+
+        remove(self.blocks)
+        remove(self.others)
+        self.length = self.length - 1
+
+    def next_position(self, positions, pos):
+        """Return the first position in the list given at or after the
+        position specified, or None if there is none."""
+
+        i = bisect.bisect_left(positions, pos)
+        if i < len(positions):
+            return positions[i]
+        else:
+            return None
+
+    def previous_position(self, positions, pos):
+        """Return the last position in the list given at or before the
+        position specified, or None if there is none."""
+
+        i = bisect.bisect_right(positions, pos)
+        if i > 0:
+            return positions[i - 1]
+        else:
+            return None
+
+
 class UEFfile:
-    """instance = UEFfile(filename, creator)
+    """instance = UEFfile(filename, creator, lazy)
 
     Create an instance of a UEF container using an existing file.
     If filename is not defined then create a new UEF container.
     The creator parameter can be used to override the default
     creator string.
 
+    If lazy is True then the chunks in the file are indexed instead of being
+    read into memory, and the contents list is only created when it is first
+    used.
     """
 
-    def __init__(self, filename = None, creator = 'UEFfile '+version):
+    def __init__(self, filename = None, creator = 'UEFfile '+version,
+                 lazy = False):
         """Create a new instance of the UEFfile class."""
 
+        # Segments of the list of chunks during an edit (see begin_edit)
+        self.segments = None
+
+        # Index of the positions of chunks (see chunk_positions)
+        self.positions = None
+
+        # Name of the file whose memory-mapped data the chunks refer to
+        self.mapped_file = None
+
         if filename == None:
 
             # There are no chunks initially
@@ -104,6 +333,17 @@ class UEFfile:
 
             # Decode the UEF file
             
+            if lazy:
+
+                # Index the chunks, leaving their data in the file
+                self.chunks = self.index_chunks(in_f)
+                in_f.close()
+
+                self.read_uef_details()
+
+                # The contents list is created when it is first accessed.
+                return
+
             # List of chunks
             self.chunks = []
             
@@ -136,8 +376,39 @@ class UEFfile:
             self.read_contents()
 
 
+    def __getattr__(self, name):
+
+        # The contents of lazily loaded files are read on demand.
+        if name == 'contents' and self.__dict__.has_key('chunks'):
+
+            self.read_contents()
+            return self.contents
+
+        raise AttributeError, name
+
+
+    def index_chunks(self, in_f):
+        """Return a ChunkIndex for the chunks in the open file object given,
+        which must be positioned at the start of the first chunk."""
+
+        if isinstance(in_f, gzip.GzipFile):
+
+            # Compressed files are decompressed into a single string which
+            # is shared by all the chunks.
+            return ChunkIndex(in_f.read())
+
+        try:
+            data = mmap.mmap(in_f.fileno(), 0, access = mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            raise UEFfile_error, "Couldn't map the input file into memory."
+
+        self.mapped_file = in_f.name
+        return ChunkIndex(data, in_f.tell())
+
+
     def write(self, filename, write_creator_info = True,
-              write_machine_info = True, write_emulator_info = True):
+              write_machine_info = True, write_emulator_info = True,
+              chunks = None, compresslevel = 9):
         """
         Write a UEF file containing all the information stored in an
         instance of UEFfile to the file with the specified filename.
@@ -145,34 +416,103 @@ class UEFfile:
         By default, information about the file's creator, target machine and
         emulator is written to the file. These can be omitted by calling this
         method with individual arguments set to False.
+
+        The chunks written are taken from the list of chunks unless another
+        sequence or iterator of (chunk ID, data) tuples is given. The file is
+        compressed using gzip with the compresslevel given, from 1 to 9, or
+        left uncompressed if compresslevel is 0.
+
+        Returns a dictionary mapping the ID of each type of chunk written to
+        the number of bytes written for chunks of that type.
         """
 
+        # Chunks indexed lazily refer to the data in the file they were read
+        # from, so copy them before that file is replaced.
+        if self.mapped_file is not None and os.path.exists(filename) and \
+           os.path.samefile(filename, self.mapped_file):
+
+            if chunks is not None:
+                chunks = self.copy_chunks(chunks)
+
+            self.detach()
+
         # Open the UEF file for writing
         try:
-            uef = gzip.open(filename, 'wb')
+            if compresslevel:
+                uef = gzip.open(filename, 'wb', compresslevel)
+            else:
+                uef = open(filename, 'wb')
         except IOError:
             raise UEFfile_error, "Couldn't open %s for writing." % filename
-    
+
+        try:
+            sizes = self.write_stream(uef, write_creator_info,
+                                      write_machine_info, write_emulator_info,
+                                      chunks)
+        finally:
+            # Close the file
+            uef.close()
+
+        return sizes
+
+
+    def copy_chunks(self, chunks):
+        """Return a list of the chunks in the sequence or iterator given with
+        their data copied into strings."""
+
+        return map(lambda (chunk_id, data): (chunk_id, str(data)), chunks)
+
+
+    def detach(self):
+        """Copy the data of lazily indexed chunks into memory so that they no
+        longer refer to the file they were read from."""
+
+        if self.mapped_file is None:
+            return
+
+        old_chunks = self.chunks
+        self.chunks = self.copy_chunks(old_chunks)
+
+        # Keep the index of chunk positions, which is still valid.
+        if self.positions is not None and self.positions.chunks is old_chunks:
+            self.positions.chunks = self.chunks
+
+        self.mapped_file = None
+
+
+    def write_stream(self, file, write_creator_info = True,
+                     write_machine_info = True, write_emulator_info = True,
+                     chunks = None):
+        """
+        Write the UEF file header, information chunks and chunks to an open
+        file object, writing each chunk as it is obtained from the sequence or
+        iterator of chunks given, or from the list of chunks by default.
+
+        Returns a dictionary mapping the ID of each type of chunk written to
+        the number of bytes written for chunks of that type.
+        """
+
+        sizes = {}
+
         # Write the UEF file header
-        self.write_uef_header(uef)
+        self.write_uef_header(file)
 
         if write_creator_info:
             # Write the UEF creator chunk to the file
-            self.write_uef_creator(uef)
+            sizes[0] = self.write_uef_creator(file)
 
         if write_machine_info:
             # Write the machine information
-            self.write_machine_info(uef)
+            sizes[5] = self.write_machine_info(file)
 
         if write_emulator_info:
             # Write the emulator information
-            self.write_emulator_info(uef)
-    
+            sizes[0xff00] = self.write_emulator_info(file)
+
         # Write the chunks to the file
-        self.write_chunks(uef)
-    
-        # Close the file
-        uef.close()
+        self.write_chunks(file, chunks, sizes)
+
+        return sizes
 
 
     def number(self, size, n):
@@ -242,28 +582,65 @@ class UEFfile:
 
 
     def crc(self, s):
+        """Return the CRC of the string given, using a lookup table to process
+        a byte at a time. The result is arranged so that writing it as a
+        little endian number stores the high byte of the CRC first."""
 
-        high = 0
-        low = 0
+        crc = 0
+        table = crc_table
 
-        for i in s:
+        for i in bytearray(s):
 
-            high = high ^ ord(i)
+            crc = ((crc << 8) & 0xffff) ^ table[(crc >> 8) ^ i]
 
-            for j in range(0,8):
+        return (crc >> 8) | ((crc & 0xff) << 8)
 
-                a, carry = self.rol(high, 0)
+    # CRC calculation routines (end)
 
-                if carry == 1:
-                    high = high ^ 8
-                    low = low ^ 16
+    def verify_blocks(self):
+        """
+        Check the header and data CRCs of every file block in the list of
+        chunks. Return a list of tuples describing the corrupt blocks:
 
-                low, carry = self.rol(low, carry)
-                high, carry = self.rol(high, carry)
+            (position, name, block number, header CRC valid, data CRC valid)
 
-        return high | (low << 8)
+        An empty list is returned if all blocks are intact.
+        """
 
-    # CRC calculation routines (end)
+        corrupt = []
+
+        for position in range(len(self.chunks)):
+
+            chunk = self.chunks[position]
+
+            if chunk[0] not in (0x100, 0x102) or len(chunk[1]) <= 1:
+                continue
+
+            block = self.block_data(chunk)
+
+            # Find the end of the name to locate the rest of the header
+            a = 1
+            while a < len(block) and block[a] != '\000':
+                a = a + 1
+
+            name = block[1:a]
+            a = a + 1
+
+            if len(block) < a + 21:
+
+                # The block is too short to contain a header and data
+                corrupt.append((position, name, None, False, False))
+                continue
+
+            block_number = self.str2num(2, block[a+8:a+10])
+
+            header_valid = self.str2num(2, block[a+17:a+19]) == self.crc(block[1:a+17])
+            data_valid = self.str2num(2, block[-2:]) == self.crc(block[a+19:-2])
+
+            if not header_valid or not data_valid:
+                corrupt.append((position, name, block_number, header_valid, data_valid))
+
+        return corrupt
 
     def read_contents(self):
         """Find the positions of files in the list of chunks"""
@@ -272,6 +649,9 @@ class UEFfile:
         self.contents = []
         
         current_file = {}
+
+        # Data from the blocks in the current file
+        blocks = []
         
         position = 0
         
@@ -284,7 +664,7 @@ class UEFfile:
                 # No more blocks, so store the details of the last file in
                 # the contents list
                 if current_file != {}:
-                    self.contents.append(current_file)
+                    self.end_file(current_file, blocks)
                 break
         
             else:
@@ -292,48 +672,35 @@ class UEFfile:
                 # Read the block information
                 name, load, exec_addr, data, block_number, last = self.read_block(self.chunks[position])
         
-                if current_file == {}:
+                if current_file == {} or block_number == 0:
+        
+                    # New file, so write the previous one to the contents
+                    # list if there is one
+                    if current_file != {}:
+                        self.end_file(current_file, blocks)
         
-                    # No current file, so store details
-                    current_file = {'name': name, 'load': load, 'exec': exec_addr, 'blocks': block_number, 'data': data}
+                    # Store details of this new file
+                    current_file = {'name': name, 'load': load, 'exec': exec_addr, 'blocks': block_number,
+                                    'block positions': [], 'block offsets': []}
+                    blocks = []
+                    length = 0
         
                     # Locate the first non-block chunk before the block
                     # and store the position of the file
                     current_file['position'] = self.find_file_start(position)
-                    # This may also be the position of the last chunk related to
-                    # this file in the archive
-                    current_file['last position'] = position
                 else:
+                    # Not a new file, so update the number of blocks
+                    current_file['blocks'] = block_number
         
-                    # Current file exists
-                    if block_number == 0:
+                # Record where the block is stored and where its data starts
+                # in the file, then collect its data
+                current_file['block positions'].append(position)
+                current_file['block offsets'].append(length)
+                blocks.append(data)
+                length = length + len(data)
         
-                        # New file, so write the previous one to the
-                        # contents list, but before doing so, find the next
-                        # non-block chunk and mark that as the last chunk in
-                        # the file
-        
-                        if current_file != {}:
-                            self.contents.append(current_file)
-        
-                        # Store details of this new file
-                        current_file = {'name': name, 'load': load, 'exec': exec_addr, 'blocks': block_number, 'data': data}
-        
-                        # Locate the first non-block chunk before the block
-                        # and store the position of the file
-                        current_file['position'] = self.find_file_start(position)
-                        # This may also be the position of the last chunk related to
-                        # this file in the archive
-                        current_file['last position'] = position
-                    else:
-                        # Not a new file, so update the number of
-                        # blocks and append the block data to the
-                        # data entry
-                        current_file['blocks'] = block_number
-                        current_file['data'] = current_file['data'] + data
-        
-                        # Update the last position information to mark the end of the file
-                        current_file['last position'] = position
+                # Update the last position information to mark the end of the file
+                current_file['last position'] = position
         
             # Increase the position
             position = position + 1
@@ -344,10 +711,119 @@ class UEFfile:
             # 3) the number of blocks they contain
             # 4) their data, and from this their length
             # 5) their start position (chunk number) in the archive
+            # 6) the positions of their blocks in the archive and the offsets
+            #    of the blocks in their data
+
+
+    def end_file(self, current_file, blocks):
+        """Join the data from the blocks collected for a file and add the file
+        to the contents list."""
+
+        current_file['data'] = ''.join(blocks)
+        self.contents.append(current_file)
+
+
+    def iter_members(self):
+        """Generate the details of each file in the list of chunks in turn without
+        reading their data. Each entry has the same form as those in the contents
+        list, except that it has no 'data' entry, and is produced as soon as the
+        last block of the file is found. Use read_member to obtain the file data."""
+
+        current_file = {}
+        position = 0
+
+        while 1:
+
+            position = self.find_next_block(position)
+
+            if position == None:
+                break
+
+            block = self.block_data(self.chunks[position])
+            name, load, exec_addr, block_number, last, offset = self.read_block_header(block)
+
+            if current_file != {} and block_number == 0:
+
+                # A new file has started without the previous one being
+                # marked as finished
+                yield current_file
+                current_file = {}
+
+            if current_file == {}:
+
+                current_file = {'name': name, 'load': load, 'exec': exec_addr, 'blocks': block_number,
+                                'block positions': [], 'block offsets': [],
+                                'position': self.find_file_start(position)}
+                length = 0
+            else:
+                current_file['blocks'] = block_number
+
+            current_file['block positions'].append(position)
+            current_file['block offsets'].append(length)
+            current_file['last position'] = position
+            length = length + max(0, len(block) - offset - 2)
+
+            if last:
+                yield current_file
+                current_file = {}
+
+            position = position + 1
+
+        if current_file != {}:
+            yield current_file
+
+
+    def read_member(self, details):
+        """Return the data for the file described by the contents entry given,
+        decoding only the blocks that belong to it."""
+
+        blocks = []
+
+        for position in details['block positions']:
+
+            name, load, exec_addr, data, block_number, last = self.read_block(self.chunks[position])
+            blocks.append(data)
+
+        return ''.join(blocks)
+
+
+    def open_member(self, name):
+        """Find the first file with the given name and return its contents entry,
+        including its data, without reading any of the files that follow it."""
+
+        for details in self.iter_members():
+
+            if details['name'] == name:
+
+                details['data'] = self.read_member(details)
+                return details
+
+        raise UEFfile_error, 'File not found: %s' % name
+
+
+    def export_block(self, file_position, block_number):
+        """
+        Return the data stored in the block with the given index in the file
+        at the specified position in the list of contents. Only the chunk
+        containing the block is decoded.
+        """
+
+        if file_position < 0 or file_position >= len(self.contents):
+
+            raise UEFfile_error, 'File position %i does not correspond to an actual file.' % file_position
+
+        positions = self.contents[file_position]['block positions']
+
+        if block_number < 0 or block_number >= len(positions):
+
+            raise UEFfile_error, 'File %i has no block %i.' % (file_position, block_number)
+
+        return self.read_block(self.chunks[positions[block_number]])[3]
 
 
     def chunk(self, f, n, data):
-        """Write a chunk to the file specified by the open file object, chunk number and data supplied."""
+        """Write a chunk to the file specified by the open file object, chunk number and data supplied.
+        Returns the number of bytes written."""
 
         # Chunk ID
         f.write(self.number(2, n))
@@ -356,10 +832,12 @@ class UEFfile:
         # Data
         f.write(data)
 
+        return 6 + len(data)
 
-    def read_block(self, chunk):
-        """Read a data block from a tape chunk and return the program name, load and execution addresses,
-        block data, block number and whether the block is supposedly the last in the file."""
+
+    def block_data(self, chunk):
+        """Return the bytes of a file block stored in a tape chunk, removing
+        the start and stop bits from blocks stored in 0x102 chunks."""
 
         # Chunk number and data
         chunk_id = chunk[0]
@@ -373,66 +851,99 @@ class UEFfile:
 
         else:   # 0x102
 
-            if self.major == 0 and self.minor < 9:
+            block = self.decode_bits(data)
 
-                # For UEF file versions earlier than 0.9, the number of
-                # excess bits to be ignored at the end of the stream is
-                # set to zero implicitly
-                ignore = 0
-                bit_ptr = 0
-            else:
-                # For later versions, the number of excess bits is
-                # specified in the first byte of the stream
-                ignore = data[0]
-                bit_ptr = 8
+        return block
 
-            # Convert the data to the implicit format
-            block = []
-            write_ptr = 0
 
-            after_end = (len(data)*8) - ignore
-            if after_end % 10 != 0:
+    def decode_bits(self, data):
+        """Return the bytes stored in the data from a 0x102 chunk, removing
+        the start and stop bits around each byte."""
 
-                # Ensure that the number of bits to be read is a
-                # multiple of ten
-                after_end = after_end - (after_end % 10)
+        if self.major == 0 and self.minor < 9:
 
-            while bit_ptr < after_end:
+            # For UEF file versions earlier than 0.9, the number of
+            # excess bits to be ignored at the end of the stream is
+            # set to zero implicitly
+            ignore = 0
+            data = str(data)
+        else:
+            # For later versions, the number of excess bits is
+            # specified in the first byte of the stream
+            ignore = ord(data[0])
+            data = str(data[1:])
 
-                # Skip start bit
-                bit_ptr = bit_ptr + 1
+        # Only complete ten bit frames are decoded
+        frames = max(0, (len(data) * 8 - ignore) / 10)
 
-                # Read eight bits of data
-                bit_offset = bit_ptr % 8
-                if bit_offset == 0:
-                    # Write the byte to the block
-                    block[write_ptr] = data[bit_ptr >> 3]
-                else:
-                    # Read the byte containing the first bits
-                    b1 = data[bit_ptr >> 3]
-                    # Read the byte containing the rest
-                    b2 = data[(bit_ptr >> 3) + 1]
+        # Pad the data to contain a whole number of five byte groups
+        groups = (frames + 3) / 4
+        data = data[:groups * 5] + ('\000' * (groups * 5 - len(data)))
+
+        # Combine the parts of each byte from the bytes in every group that
+        # contain them, using lookup tables to shift them into place
+        block = bytearray(groups * 4)
 
-                    # Construct a byte of data
-                    # Shift the first byte right by the bit offset
-                    # in that byte
-                    b1 = b1 >> bit_offset
+        for j in range(4):
 
-                    # Shift the rest of the bits from the second
-                    # byte to the left and ensure that the result
-                    # fits in a byte
-                    b2 = (b2 << (8 - bit_offset)) & 0xff
+            (low, low_shift), (high, high_shift) = decode_parts[j]
+            low = bytearray(data[low::5].translate(decode_tables[low_shift]))
+            high = bytearray(data[high::5].translate(decode_tables[high_shift]))
+            block[j::4] = bytearray(map(operator.or_, low, high))
 
-                    # OR the two bytes together and write it to
-                    # the block
-                    block[write_ptr] = b1 | b2
+        return str(block[:frames])
 
-                # Increment the block pointer
-                write_ptr = write_ptr + 1
 
-                # Move the data pointer on eight bits and skip the
-                # stop bit
-                bit_ptr = bit_ptr + 9
+    def encode_bits(self, data):
+        """Return the data for a 0x102 chunk containing the bytes given, each
+        surrounded by a start bit and a stop bit."""
+
+        frames = len(data)
+
+        # Pad the data to contain a whole number of four byte groups
+        groups = (frames + 3) / 4
+        data = bytearray(data) + bytearray(groups * 4 - frames)
+
+        # Each group of four framed bytes fills five bytes in the chunk
+        out = bytearray(groups * 5)
+
+        for k in range(5):
+
+            value = bytearray(groups)
+
+            for j, shift in encode_parts[k]:
+                value = bytearray(map(operator.or_, value,
+                                      data[j::4].translate(encode_tables[shift])))
+
+            out[k::5] = value
+
+        length = (frames * 10 + 7) / 8
+
+        if self.major == 0 and self.minor < 9:
+            header = ''
+        else:
+            # Record the number of excess bits in the last byte
+            ignore = (length * 8) - (frames * 10)
+            header = chr(ignore)
+
+        return header + str(out[:length])
+
+
+    def read_block(self, chunk):
+        """Read a data block from a tape chunk and return the program name, load and execution addresses,
+        block data, block number and whether the block is supposedly the last in the file."""
+
+        block = self.block_data(chunk)
+
+        name, load, exec_addr, block_number, last, offset = self.read_block_header(block)
+
+        return (name, load, exec_addr, block[offset:-2], block_number, last)
+
+
+    def read_block_header(self, block):
+        """Read the header of a decoded data block and return the program name, load and
+        execution addresses, block number, whether the block is supposedly the last in the
+        file and the offset of the block data."""
 
         # Read the block
         name = ''
@@ -455,7 +966,7 @@ class UEFfile:
         else:
             last = 0
 
-        return (name, load, exec_addr, block[a+19:-2], block_number, last)
+        return (name, load, exec_addr, block_number, last, a + 19)
 
 
     def write_block(self, block, name, load, exe, n, last = 0, flags = 0):
@@ -510,79 +1021,89 @@ class UEFfile:
             return path
 
 
+    def chunk_positions(self):
+        """Return the index of chunk positions for the list of chunks, creating
+        it if the list has been replaced or resized since it was created."""
+
+        positions = self.positions
+
+        if positions is None or positions.chunks is not self.chunks or \
+            positions.length != len(self.chunks):
+
+            positions = self.positions = PositionIndex(self.chunks)
+
+        return positions
+
+
+    def remove_chunk(self, pos):
+        """Remove the chunk at the given position, updating the index of chunk
+        positions."""
+
+        positions = self.chunk_positions()
+        del self.chunks[pos]
+        positions.remove(pos)
+
+
     def find_next_chunk(self, pos, IDs):
         """position, chunk = find_next_chunk(start, IDs)
         Search through the list of chunks from the start position given
         for the next chunk with an ID in the list of IDs supplied.
         Return its position in the list of chunks and its details."""
 
-        while pos < len(self.chunks):
+        positions = self.chunk_positions()
+        found = None
 
-            if self.chunks[pos][0] in IDs:
+        for ID in IDs:
 
-                # Found a chunk with ID in the list
-                return pos, self.chunks[pos]
+            if positions.ids.has_key(ID):
 
-            # Otherwise continue looking
-            pos = pos + 1
+                candidate = positions.next_position(positions.ids[ID], pos)
+                if candidate != None and (found == None or candidate < found):
+                    found = candidate
 
-        return None, None
+        if found == None:
+            return None, None
+
+        return found, self.chunks[found]
 
 
     def find_next_block(self, pos):
         """Find the next file block in the list of chunks."""
 
-        while pos < len(self.chunks):
-
-            pos, chunk = self.find_next_chunk(pos, [0x100, 0x102])
-
-            if pos == None:
-
-                return None
-            else:
-                if len(chunk[1]) > 1:
-
-                    # Found a block, return this position
-                    return pos
-
-            # Otherwise continue looking
-            pos = pos + 1
-
-        return None
+        positions = self.chunk_positions()
+        return positions.next_position(positions.blocks, pos)
 
 
     def find_file_start(self, pos):
         """Find a chunk before the one specified which is not a file block."""
 
         pos = pos - 1
-        while pos > 0:
-
-            if self.chunks[pos][0] != 0x100 and self.chunks[pos][0] != 0x102:
+        if pos <= 0:
+            return pos
 
-                # This is not a block
-                return pos
+        positions = self.chunk_positions()
+        found = positions.previous_position(positions.others, pos)
 
-            else:
-                pos = pos - 1
+        if found == None or found < 1:
+            return 0
 
-        return pos
+        return found
 
 
     def find_file_end(self, pos):
         """Find a chunk after the one specified which is not a file block."""
 
         pos = pos + 1
-        while pos < len(self.chunks)-1:
-
-            if self.chunks[pos][0] != 0x100 and self.chunks[pos][0] != 0x102:
+        if pos >= len(self.chunks)-1:
+            return pos
 
-                # This is not a block
-                return pos
+        positions = self.chunk_positions()
+        found = positions.next_position(positions.others, pos)
 
-            else:
-                pos = pos + 1
+        if found == None or found >= len(self.chunks)-1:
+            return len(self.chunks)-1
 
-        return pos
+        return found
 
 
     def read_uef_details(self):
@@ -599,11 +1120,11 @@ class UEFfile:
 
             self.creator = 'Unknown'
         else:
-            self.creator = chunk[1]
+            self.creator = str(chunk[1])
 
         # Delete the creator chunk
         if pos != None:
-            del self.chunks[pos]
+            self.remove_chunk(pos)
 
         # Find the target machine chunk
         pos, chunk = self.find_next_chunk(0, [0x5])
@@ -631,7 +1152,7 @@ class UEFfile:
                 self.keyboard_layout = 'Unknown'
 
             # Delete the target machine chunk
-            del self.chunks[pos]
+            self.remove_chunk(pos)
 
         # Find the emulator chunk
         pos, chunk = self.find_next_chunk(0, [0xff00])
@@ -644,11 +1165,11 @@ class UEFfile:
 
             self.emulator = 'Unknown'
         else:
-            self.emulator = chunk[1]
+            self.emulator = str(chunk[1])
 
         # Delete the emulator chunk
         if pos != None:
-            del self.chunks[pos]
+            self.remove_chunk(pos)
 
         # Remove trailing null bytes
         while len(self.creator) > 0 and self.creator[-1] == '\000':
@@ -687,7 +1208,7 @@ class UEFfile:
             origin = origin + ('\000'*(4-(len(origin) % 4)))
 
         # Write the creator chunk
-        self.chunk(file, 0, origin)
+        return self.chunk(file, 0, origin)
 
 
     def write_machine_info(self, file):
@@ -708,7 +1229,7 @@ class UEFfile:
         else:
             keyboard = 0
 
-        self.chunk(file, 5, self.number(1, machine | (keyboard << 4) ))
+        return self.chunk(file, 5, self.number(1, machine | (keyboard << 4) ))
 
 
     def write_emulator_info(self, file):
@@ -720,20 +1241,29 @@ class UEFfile:
             emulator = emulator + ('\000'*(4-(len(emulator) % 4)))
 
         # Write the creator chunk
-        self.chunk(file, 0xff00, emulator)
+        return self.chunk(file, 0xff00, emulator)
 
 
-    def write_chunks(self, file):
-        """Write all the chunks in the list to a file. Saves having loops in other functions to do this."""
+    def write_chunks(self, file, chunks = None, sizes = None):
+        """Write all the chunks in the list to a file. Saves having loops in other functions to do this.
+        Another sequence or iterator of chunks can be given instead of the list. If a sizes
+        dictionary is given, the number of bytes written for each type of chunk is added to it."""
 
-        for c in self.chunks:
+        if chunks is None:
+            chunks = self.chunks
+
+        if sizes is None:
+            sizes = {}
+
+        for c in chunks:
 
-            self.chunk(file, c[0], c[1])
+            sizes[c[0]] = sizes.get(c[0], 0) + self.chunk(file, c[0], c[1])
 
 
-    def create_chunks(self, name, load, exe, data):
+    def create_chunks(self, name, load, exe, data, chunk_id = 0x100):
         """Create suitable chunks, and insert them into
-        the list of chunks."""
+        the list of chunks. Blocks are stored in 0x102 chunks, with
+        explicit start and stop bits, if chunk_id is 0x102."""
 
         # Reset the block number to zero
         block_number = 0
@@ -760,7 +1290,10 @@ class UEFfile:
                 new_chunks.append((0x110, self.number(2,0x0258)))
 
             # Write the block to the list of new chunks
-            new_chunks.append((0x100, block))
+            if chunk_id == 0x102:
+                new_chunks.append((0x102, self.encode_bits(block)))
+            else:
+                new_chunks.append((0x100, block))
 
             if last:
                 break
@@ -812,7 +1345,7 @@ class UEFfile:
         else:
             # There are no files present in the archive, so put them after
             # all the other chunks
-            position = len(self.chunks)
+            position = self.chunks_length()
 
         # Examine the info sequence passed
         if len(info) == 0:
@@ -825,22 +1358,174 @@ class UEFfile:
 
         # Read the file details for each file and create chunks to add
         # to the list of chunks
-        inserted_chunks = []
+        inserted_chunks = list(self.file_chunks(info, gap))
+
+        editing = self.segments is not None
+        if not editing:
+            self.begin_edit()
+
+        # Insert the chunks in the list at the specified position
+        i = self.split_segments(position)
+        self.segments.insert(i, (inserted_chunks, 0, len(inserted_chunks)))
+
+        # Update the contents list, decoding only the new chunks and moving
+        # the files that follow them
+        new_files = self.read_new_files(inserted_chunks, position)
+        file_position = min(file_position, len(self.contents))
+
+        self.move_files(file_position, len(inserted_chunks))
+        self.contents[file_position:file_position] = new_files
+
+        if not editing:
+            self.end_edit()
+
+
+    def file_chunks(self, info, gap = False):
+        """
+        Return an iterator which yields the chunks for each file in the
+        sequence or iterator of (name, load, exe, data) tuples given, only
+        creating the chunks for a file when they are needed. Each file will
+        be preceded by a gap, if enabled.
+
+        The result can be passed to the write method to write files to a UEF
+        file as they are created.
+        """
 
         for name, load, exe, data in info:
 
             if gap:
-                inserted_chunks += [(0x112, "\xdc\x05"),
-                                    (0x110, "\xdc\x05"),
-                                    (0x100, "\xdc")]
-            
-            inserted_chunks += self.create_chunks(name, load, exe, data)
+                yield (0x112, "\xdc\x05")
+                yield (0x110, "\xdc\x05")
+                yield (0x100, "\xdc")
 
-        # Insert the chunks in the list at the specified position
-        self.chunks = self.chunks[:position] + inserted_chunks + self.chunks[position:]
+            for chunk in self.create_chunks(name, load, exe, data):
+                yield chunk
 
-        # Update the contents list
-        self.read_contents()
+
+    def read_new_files(self, chunks, position):
+        """
+        Return a list of entries for the contents list describing the files
+        stored in the list of chunks given, which are inserted at the
+        specified position in the list of chunks.
+        """
+
+        uef = UEFfile()
+        uef.major = self.major
+        uef.minor = self.minor
+        uef.chunks = chunks
+        uef.read_contents()
+
+        for file in uef.contents:
+
+            file['position'] = file['position'] + position
+            file['last position'] = file['last position'] + position
+            file['block positions'] = map(lambda x: x + position, file['block positions'])
+
+        return uef.contents
+
+
+    def move_files(self, file_position, offset):
+        """
+        Add the offset given to the chunk positions of the files in the list
+        of contents, starting at the specified file position.
+        """
+
+        for file in self.contents[file_position:]:
+
+            file['position'] = file['position'] + offset
+            file['last position'] = file['last position'] + offset
+            file['block positions'] = map(lambda x: x + offset, file['block positions'])
+
+
+    def begin_edit(self):
+        """
+        Start a series of calls to import_files and remove_files. The contents
+        list is updated by each call, but the list of chunks is only rebuilt
+        once, when end_edit is called.
+        """
+
+        if self.segments is None:
+
+            # The list of chunks is described by a list of segments, each
+            # referring to a range of chunks in a list of existing or new
+            # chunks.
+            self.segments = [(self.chunks, 0, len(self.chunks))]
+            self.rescan = False
+
+
+    def end_edit(self):
+        """
+        Finish a series of edits started with begin_edit by rebuilding the
+        list of chunks.
+        """
+
+        if self.segments is None:
+            return
+
+        # Build the index of chunk positions from the index for the existing
+        # chunks, only examining the new chunks.
+        old = self.chunk_positions()
+        positions = PositionIndex()
+
+        chunks = []
+        for source, start, end in self.segments:
+
+            if source is old.chunks:
+                positions.copy(old, start, end)
+            else:
+                positions.add(source[start:end])
+
+            chunks += source[start:end]
+
+        positions.chunks = chunks
+        self.chunks = chunks
+        self.positions = positions
+        self.segments = None
+
+        # If a removed file overlapped another file then the contents list
+        # needs to be recreated.
+        if self.rescan:
+            self.read_contents()
+
+
+    def chunks_length(self):
+        """Return the number of chunks, including any changes made by an edit
+        in progress."""
+
+        if self.segments is None:
+            return len(self.chunks)
+
+        length = 0
+        for source, start, end in self.segments:
+            length = length + end - start
+
+        return length
+
+
+    def split_segments(self, position):
+        """
+        Return the index of the segment starting at the specified position in
+        the list of chunks, splitting an existing segment if necessary.
+        """
+
+        p = 0
+
+        for i in range(len(self.segments)):
+
+            source, start, end = self.segments[i]
+
+            if position == p:
+                return i
+
+            elif position < p + end - start:
+
+                middle = start + position - p
+                self.segments[i:i+1] = [(source, start, middle), (source, middle, end)]
+                return i + 1
+
+            p = p + end - start
+
+        return len(self.segments)
 
 
     def chunk_number(self, name):
@@ -935,6 +1620,10 @@ class UEFfile:
 
             file_positions = [file_positions]
 
+        editing = self.segments is not None
+        if not editing:
+            self.begin_edit()
+
         positions = []
         for file_position in file_positions:
     
@@ -943,23 +1632,39 @@ class UEFfile:
         
                 print 'File position %i does not correspond to an actual file.' % file_position
     
-            else:
-                # Add the chunk positions within each file to the list of positions
-                positions = positions + range(self.contents[file_position]['position'],
-                                  self.contents[file_position]['last position'] + 1)
-    
-        # Create a new list of chunks without those in the positions list
-        new_chunks = []
-        for c in range(0, len(self.chunks)): 
-    
-            if c not in positions:
-                new_chunks.append(self.chunks[c])
+            elif file_position not in positions:
+                positions.append(file_position)
+
+        # Remove the files, starting with the last one so that the positions
+        # of the others are not changed
+        positions.sort()
+        positions.reverse()
+
+        for file_position in positions:
+
+            start = self.contents[file_position]['position']
+            end = self.contents[file_position]['last position'] + 1
+
+            # Remove the segments containing the file's chunks
+            i = self.split_segments(start)
+            j = self.split_segments(end)
+            del self.segments[i:j]
+
+            del self.contents[file_position]
+            self.move_files(file_position, start - end)
+
+            # If the removed chunks overlapped a neighbouring file then the
+            # contents list needs to be recreated.
+            if file_position > 0 and \
+               self.contents[file_position - 1]['last position'] >= start:
+                self.rescan = True
 
-        # Overwrite the chunks list with this new list
-        self.chunks = new_chunks
+            if file_position < len(self.contents) and \
+               self.contents[file_position]['position'] < start:
+                self.rescan = True
 
-        # Create a new contents list
-        self.read_contents()        
+        if not editing:
+            self.end_edit()
 
 
     def printable(self, s):
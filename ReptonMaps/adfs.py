@@ -0,0 +1,262 @@
+"""
+adfs.py - Read ADFS floppy disk images.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections, struct
+
+from diskutils import Directory, DiskError, Utilities
+from makedfs import CatalogueFile
+
+class ADFSDirectory(Directory):
+
+    """directory = ADFSDirectory(catalogue, name, address, locked)
+
+    A directory found on an ADFS disk whose entries are only decoded when its
+    files attribute is used. The entries are held in the catalogue's cache of
+    directories rather than in the directory itself.
+    """
+
+    def __init__(self, catalogue, name, address, locked = False):
+
+        self.catalogue = catalogue
+        self.name = name
+        self.address = address
+        self.locked = locked
+
+    def __getattr__(self, name):
+
+        if name == "files":
+            return self.catalogue.read_directory(self.address)[3]
+        elif name == "title":
+            return self.catalogue.read_directory(self.address)[1]
+
+        raise AttributeError, name
+
+
+class Catalogue(Utilities):
+
+    """catalogue = Catalogue(file, cache_size)
+
+    Read the free space map and directories of an ADFS S, M or L disk image
+    using the old map and directory formats. Decoded directories are kept in
+    a cache holding up to cache_size directories, keyed by sector address,
+    with the least recently used directories discarded first.
+    """
+
+    root_address = 2
+    directory_length = 0x500
+
+    # The master sequence number and identifier at the start of a directory
+    directory_header = struct.Struct("<B4s")
+
+    # The name, load and execution addresses, length, start sector (as a
+    # half word and a byte) and sequence number of a directory entry
+    entry_format = struct.Struct("<10sIIIHBB")
+
+    # The end of the entries, directory name, parent address (as a half word
+    # and a byte), title, master sequence number, identifier and check byte
+    # at the end of a directory
+    directory_tail = struct.Struct("<B10sHB19s14xB4sB")
+
+    # Names are stored with attributes in the top bit of each character and
+    # are terminated by a control character.
+    name_table = "".join(map(lambda i: (i & 0x7f) > 32 and chr(i & 0x7f) or "\x00",
+                             range(256)))
+
+    def __init__(self, file, cache_size = 32):
+
+        self.file = file
+        self.sector_size = 256
+        self.cache_size = cache_size
+        self.directories = collections.OrderedDict()
+
+        self.sectors = 0
+        self.disk_id = 0
+        self.boot_option = 0
+        self.free = []
+
+    def read_free_space(self):
+
+        """Reads the free space map, returning a list of (sector, length)
+        tuples describing the runs of free sectors on the disk."""
+
+        free_map = self._read_buffer(0, 0x200)
+
+        self.sectors = self._read_unsigned_half_word(free_map, 0xfc) | \
+                       (self._read_unsigned_byte(free_map, 0xfe) << 16)
+        self.disk_id = self._read_unsigned_half_word(free_map, 0x1fb)
+        self.boot_option = self._read_unsigned_byte(free_map, 0x1fd)
+
+        # The start sectors and lengths of the runs of free space are stored
+        # as three byte values in the first and second sectors.
+        self.free = []
+        for p in range(0, min(self._read_unsigned_byte(free_map, 0x1fe), 0xf6), 3):
+
+            start = self._read_unsigned_half_word(free_map, p) | \
+                    (self._read_unsigned_byte(free_map, p + 2) << 16)
+            length = self._read_unsigned_half_word(free_map, 0x100 + p) | \
+                     (self._read_unsigned_byte(free_map, 0x100 + p + 2) << 16)
+            self.free.append((start, length))
+
+        return self.free
+
+    def read(self):
+
+        """Returns the title of the disk and a list of the objects in the root
+        directory."""
+
+        self.read_free_space()
+        name, title, parent, files = self.read_directory(self.root_address)
+        return title, files
+
+    def root(self):
+
+        return ADFSDirectory(self, "$", self.root_address)
+
+    def read_directory(self, address):
+
+        """Returns the name, title, parent address and list of objects in the
+        directory at the sector address given, decoding the directory only if
+        it is not in the cache."""
+
+        try:
+            directory = self.directories.pop(address)
+        except KeyError:
+            directory = self._decode_directory(address)
+
+            if len(self.directories) >= self.cache_size:
+                self.directories.popitem(last = False)
+
+        self.directories[address] = directory
+        return directory
+
+    def _decode_directory(self, address):
+
+        data = self._read_buffer(address * self.sector_size, self.directory_length)
+
+        sequence, identifier = self.directory_header.unpack_from(data, 0)
+        end, name, parent, parent_high, title, tail_sequence, tail_identifier, check = \
+            self.directory_tail.unpack_from(data, self.directory_length - self.directory_tail.size)
+
+        if identifier not in ("Hugo", "Nick") or tail_identifier != identifier:
+            raise DiskError, "Invalid directory at sector 0x%x." % address
+
+        files = []
+        p = self.directory_header.size
+
+        while p < self.directory_length - self.directory_tail.size and data[p] != 0:
+
+            entry_name, load, exec_, length, start, start_high, entry_sequence = \
+                self.entry_format.unpack_from(data, p)
+
+            start = start | (start_high << 16)
+            locked = (data[p + 2] & 0x80) != 0
+
+            if data[p + 3] & 0x80:
+                files.append(ADFSDirectory(self, self._name(entry_name), start, locked))
+            else:
+                # The file data is read when it is needed.
+                files.append(CatalogueFile(self, self._name(entry_name), load, exec_,
+                                           length, locked, start * self.sector_size))
+
+            p += self.entry_format.size
+
+        return self._name(name), self._name(title), parent | (parent_high << 16), files
+
+    def _name(self, s):
+
+        return s.translate(self.name_table).split("\x00")[0]
+
+    def find(self, path):
+
+        """Returns the object with the given path, such as "$.Dir.File",
+        decoding only the directories on the path. Names are compared without
+        regard to case."""
+
+        pieces = path.split(".")
+        if pieces[0] == "$":
+            pieces = pieces[1:]
+
+        obj = self.root()
+
+        for piece in pieces:
+
+            if not isinstance(obj, ADFSDirectory):
+                raise DiskError, "Not a directory: %s" % obj.name
+
+            for file in obj.files:
+                if file.name.lower() == piece.lower():
+                    obj = file
+                    break
+            else:
+                raise DiskError, "Object not found: %s" % path
+
+        return obj
+
+    def listdir(self, path = "$"):
+
+        """Returns a list of the objects in the directory with the given path."""
+
+        directory = self.find(path)
+        if not isinstance(directory, ADFSDirectory):
+            raise DiskError, "Not a directory: %s" % directory.name
+
+        return directory.files
+
+    def walk(self, path = "$"):
+
+        """Generates (path, directories, files) tuples for the directory with
+        the given path and each of its subdirectories in turn, decoding each
+        directory only when it is reached."""
+
+        pending = [path]
+
+        while pending:
+
+            path = pending.pop(0)
+            directories = []
+            files = []
+
+            for obj in self.listdir(path):
+                if isinstance(obj, ADFSDirectory):
+                    directories.append(obj)
+                else:
+                    files.append(obj)
+
+            yield path, directories, files
+
+            pending += map(lambda directory: path + "." + directory.name, directories)
+
+
+class Disk:
+
+    # Formats: "S" for 40 track single-sided images, "M" for 80 track
+    # single-sided images and "L" for 80 track double-sided images with the
+    # sectors in the order used by the filing system.
+    DiskSizes = {"S": 160 * 1024, "M": 320 * 1024, "L": 640 * 1024}
+
+    def __init__(self, format = None):
+
+        self.format = format
+
+    def open(self, file_object):
+
+        self.file = file_object
+
+    def catalogue(self, cache_size = 32):
+
+        # Directories are only read when they are first used.
+        return Catalogue(self.file, cache_size)
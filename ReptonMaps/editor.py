@@ -25,7 +25,7 @@ from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 
 from Repton import Repton
-from Repton2 import Repton2
+from Repton2 import Repton2, TooManyAreas
 import UEFfile
 
 __version__ = "0.2"
@@ -212,6 +212,7 @@ class LevelWidget(QWidget):
 
     destinationRequested = pyqtSignal(int, int, int)
     puzzlePieceMoved = pyqtSignal(int)
+    tilesChanged = pyqtSignal()
     
     def __init__(self, repton, parent = None):
     
@@ -235,6 +236,8 @@ class LevelWidget(QWidget):
             self.ys = 1
         
         self.levels = []
+        self.tile_counts = []
+        self.display_tiles = []
         self.level_number = 1
         self.currentTile = 0
         self.highlight = None
@@ -268,7 +271,7 @@ class LevelWidget(QWidget):
     
     def loadLevels(self):
     
-        self.levels = self.repton.read_levels()
+        self.setLevels(self.repton.read_levels())
         
         if isinstance(self.repton, Repton2):
         
@@ -276,6 +279,42 @@ class LevelWidget(QWidget):
             self.transporters = DataDict(transporters)
             self.destinations = DataDict(destinations)
             self.puzzle, self.piece_numbers = self.repton.read_puzzle_defs()
+            self.updateDisplayTiles()
+    
+    def setLevels(self, levels):
+    
+        self.levels = levels
+        self.display_tiles = []
+        
+        # Keep counts of the tiles on each screen so that the totals can be
+        # found without examining every level.
+        if isinstance(self.repton, Repton2):
+            self.tile_counts = map(self.repton.count_tiles, levels)
+    
+    def setCell(self, screen, c, r, tile):
+    
+        row = self.levels[screen][r]
+        
+        if self.tile_counts:
+            counts = self.tile_counts[screen]
+            counts[row[c]] -= 1
+            counts[tile] += 1
+        
+        row[c] = tile
+        
+        if self.display_tiles:
+            self.display_tiles[screen][r][c] = self._display_tile(screen, c, r)
+    
+    def updateDisplayTiles(self):
+    
+        # Record the tile shown for each cell on each screen so that the
+        # transporter and puzzle definitions are only consulted when cells
+        # change rather than whenever they are painted.
+        self.display_tiles = []
+        
+        for screen in range(len(self.levels)):
+            self.display_tiles.append([[self._display_tile(screen, c, r) for c in range(32)]
+                                       for r in range(32)])
     
     def setTileImages(self, tile_images):
     
@@ -301,7 +340,7 @@ class LevelWidget(QWidget):
                 for column in range(32):
                     if (column, row) in self.transporters[self.level_number - 1] \
                       and self.levels[self.level_number - 1][row][column] != 2:
-                        self.levels[self.level_number - 1][row][column] = 2
+                        self.setCell(self.level_number - 1, column, row, 2)
         
         self.update()
     
@@ -352,18 +391,15 @@ class LevelWidget(QWidget):
         c1 = self._column_from_x(x1)
         c2 = self._column_from_x(x2)
         
+        if self.display_tiles:
+            tiles = self.display_tiles[self.level_number - 1]
+        else:
+            tiles = self.levels[self.level_number - 1]
+        
         for r in range(r1, r2 + 1):
             for c in range(c1, c2 + 1):
             
-                tile = self.levels[self.level_number - 1][r][c]
-                
-                if isinstance(self.repton, Repton2):
-                    if tile == 2:
-                        tile = self.getTransporterOrPuzzleTile(r, c)
-                    elif tile == 9:
-                        tile = self.getFinishOrSpiritTile(r, c)
-                
-                tile_image = self.tile_images[tile]
+                tile_image = self.tile_images[tiles[r][c]]
                 
                 painter.drawImage(c * self.tw * self.xs, r * self.th * self.ys,
                                   tile_image)
@@ -456,30 +492,31 @@ class LevelWidget(QWidget):
     
         return c * self.tw * self.xs
     
-    def getTransporterOrPuzzleTile(self, r, c):
-    
-        try:
-            if (c, r) in self.transporters[self.level_number - 1]:
-                # Transporters actually use tile 11.
-                return 11
-            elif (c, r) in self.puzzle[self.level_number - 1]:
-                # Our puzzle piece numbers are recorded in the first tuple
-                # element. We translate this to a tile number.
-                return self.puzzle[self.level_number - 1][(c, r)][0] + 32
-        except KeyError:
-            pass
-        
-        # We should never reach here with self-consistent data.
-        return 0
-    
-    def getFinishOrSpiritTile(self, r, c):
-    
-        # Replace the finishing piece with spirits on all levels except for
-        # the first.
-        if self.level_number == 1:
-            return 9
-        else:
+    def _display_tile(self, screen, c, r):
+    
+        tile = self.levels[screen][r][c]
+        
+        if tile == 2:
+            try:
+                if (c, r) in self.transporters[screen]:
+                    # Transporters actually use tile 11.
+                    return 11
+                elif (c, r) in self.puzzle[screen]:
+                    # Our puzzle piece numbers are recorded in the first tuple
+                    # element. We translate this to a tile number.
+                    return self.puzzle[screen][(c, r)][0] + 32
+            except KeyError:
+                pass
+            
+            # We should never reach here with self-consistent data.
+            return 0
+        
+        elif tile == 9 and screen != 0:
+            # Replace the finishing piece with spirits on all levels except
+            # for the first.
             return 74
+        
+        return tile
     
     def updateCell(self, c, r):
     
@@ -512,7 +549,7 @@ class LevelWidget(QWidget):
             if previous == 2:
             
                 # Find out what the previous tile refer to.
-                actual_previous = self.getTransporterOrPuzzleTile(r, c)
+                actual_previous = self.display_tiles[self.level_number - 1][r][c]
                 
                 # If there is no change, just return.
                 if actual_previous == tile:
@@ -575,7 +612,7 @@ class LevelWidget(QWidget):
                     # entry in the number dictionary will be redefined. Place a
                     # blank tile where the piece used to be.
                     del self.puzzle[old_screen][(old_x, old_y)]
-                    self.levels[old_screen][old_y][old_x] = 0
+                    self.setCell(old_screen, old_x, old_y, 0)
                 except KeyError:
                     pass
                 
@@ -587,8 +624,9 @@ class LevelWidget(QWidget):
                 # Insert tile 2 instead.
                 tile = 2
         
-        self.levels[self.level_number - 1][r][c] = tile
+        self.setCell(self.level_number - 1, c, r, tile)
         self.updateCell(c, r)
+        self.tilesChanged.emit()
     
     def setDestination(self, details):
     
@@ -662,6 +700,8 @@ class TotalsWidget(QWidget):
         
         self.levelWidget = levelWidget
         self.calculated = False
+        self.live = False
+        self.updating = False
         
         self.diamondsEdit = QSpinBox()
         self.diamondsEdit.setMaximum(9999)
@@ -674,8 +714,14 @@ class TotalsWidget(QWidget):
         self.puzzleEdit = QSpinBox()
         self.puzzleEdit.setMaximum(42)
         
+        # Stop following changes to the levels when a total is edited.
+        for edit in (self.diamondsEdit, self.earthEdit, self.monstersEdit,
+                     self.transportersEdit, self.puzzleEdit):
+            edit.valueChanged[int].connect(self.totalEdited)
+        
         recalcButton = QPushButton(self.tr("&Recalculate"))
         recalcButton.clicked.connect(self.recalculateTotals)
+        levelWidget.tilesChanged.connect(self.updateTotals)
         
         layout = QVBoxLayout(self)
         
@@ -691,12 +737,26 @@ class TotalsWidget(QWidget):
     
     def recalculateTotals(self):
     
-        totals = self.levelWidget.repton.recalculateTotals(
-            self.levelWidget.levels, self.levelWidget.transporters,
+        totals = self.levelWidget.repton.totals_from_counts(
+            self.levelWidget.tile_counts, self.levelWidget.transporters,
             self.levelWidget.piece_numbers)
         
         self.setTotals(totals)
         self.calculated = True
+        self.live = True
+    
+    def updateTotals(self):
+    
+        # Calculated totals follow changes to the levels, but totals that
+        # were set explicitly are left alone.
+        if self.live:
+            self.recalculateTotals()
+    
+    def totalEdited(self, value):
+    
+        # Values set by setTotals are not edits made by the user.
+        if not self.updating:
+            self.live = False
     
     def totals(self):
     
@@ -710,12 +770,15 @@ class TotalsWidget(QWidget):
     def setTotals(self, totals):
     
         diamonds, earth, monsters, transporters, pieces = totals
+        self.live = False
         
+        self.updating = True
         self.diamondsEdit.setValue(diamonds)
         self.earthEdit.setValue(earth)
         self.monstersEdit.setValue(monsters)
         self.transportersEdit.setValue(transporters)
         self.puzzleEdit.setValue(pieces)
+        self.updating = False
 
 
 class EditorWindow(QMainWindow):
@@ -769,7 +832,13 @@ class EditorWindow(QMainWindow):
                                            self.path, file_type)
         if not path.isEmpty():
         
-            if self.saveLevels(unicode(path)):
+            try:
+                saved = self.saveLevels(unicode(path))
+            except TooManyAreas, exception:
+                QMessageBox.warning(self, self.tr("Save Levels"), str(exception))
+                return
+            
+            if saved:
                 self.path = path
                 self.setWindowTitle(self.tr(path))
             else:
@@ -813,7 +882,7 @@ class EditorWindow(QMainWindow):
             else:
                 d = deserialize(open(path))
             
-            self.levelWidget.levels = d["levels"]
+            self.levelWidget.setLevels(d["levels"])
             
             if isinstance(self.repton, Repton2):
             
@@ -822,6 +891,7 @@ class EditorWindow(QMainWindow):
                 self.levelWidget.puzzle = d["puzzle"]
                 self.levelWidget.piece_numbers = d["piece numbers"]
                 self.totalsDock.widget().setTotals(d["totals"])
+                self.levelWidget.updateDisplayTiles()
             
             if path.endswith(".lev"):
                 d.close()
@@ -0,0 +1,243 @@
+"""
+imagecache.py - A persistent cache of the files found in tape and disk images.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib, mmap, os, struct, tempfile
+
+import UEFfile
+import adfs, imageformat, makedfs
+from diskutils import File
+
+class CacheError(Exception):
+    pass
+
+
+def read_uef(path, format):
+
+    uef = UEFfile.UEFfile(path, lazy = True)
+    files = []
+
+    for details in uef.contents:
+
+        files.append(File(details["name"], details["data"], details["load"],
+                          details["exec"], len(details["data"])))
+
+    return files
+
+def read_dfs(path, format):
+
+    disk = makedfs.Disk(imageformat.dfs_formats[format])
+    disk.open(open(path, "rb"))
+    files = []
+
+    for side in range(disk.Sides[disk.format]):
+        title, side_files = disk.catalogue(side).read()
+        files += side_files
+
+    return files
+
+def read_adfs(path, format):
+
+    disk = adfs.Disk()
+    disk.open(open(path, "rb"))
+    files = []
+
+    # Record the full path of each file.
+    for directory, subdirectories, directory_files in disk.catalogue().walk():
+        for file in directory_files:
+            file.name = directory + "." + file.name
+            files.append(file)
+
+    return files
+
+
+class ImageCache:
+
+    """cache = ImageCache(directory, max_size)
+
+    Store the names, load and execution addresses and data of the files in
+    tape and disk images in the directory given, using the SHA-1 hash of the
+    contents of each image as the key. Each entry is a single file containing
+    a header, a table of files and their data, so that opening a cached image
+    only involves mapping the entry into memory and reading the table.
+
+    The least recently used entries are removed when the total size of the
+    entries exceeds max_size bytes.
+    """
+
+    # Readers for the image formats identified by the imageformat module.
+    readers = {imageformat.UEF: read_uef, imageformat.GZIP_UEF: read_uef,
+               imageformat.SSD: read_dfs, imageformat.DSD: read_dfs,
+               imageformat.DSD40: read_dfs, imageformat.ADFS: read_adfs}
+
+    # The file name suffixes of images to look for in directories.
+    suffixes = ("uef", "ssd", "dsd", "adf", "adl")
+
+    magic = "IMGCACHE"
+    version = 1
+
+    # Magic, version, number of files, offset of the data
+    header = struct.Struct("<8sHHI")
+
+    # Load address, execution address, data offset, data length, name length
+    entry = struct.Struct("<IIIIB")
+
+    def __init__(self, directory = None, max_size = 64 * 1024 * 1024):
+
+        if directory is None:
+            directory = os.path.join(os.path.expanduser("~"), ".cache", "imagecache")
+
+        self.directory = directory
+        self.max_size = max_size
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, path):
+
+        """Returns the key used to store the files for the image at the given
+        path, which is the hexadecimal SHA-1 hash of the image's contents."""
+
+        h = hashlib.sha1()
+        f = open(path, "rb")
+
+        while True:
+            s = f.read(65536)
+            if not s:
+                break
+            h.update(s)
+
+        f.close()
+        return h.hexdigest()
+
+    def files(self, path):
+
+        """Returns a list of File objects for the files in the image at the
+        given path, reading them from the cache if the image has been read
+        before, or reading the image and storing its files otherwise."""
+
+        key = self.key(path)
+        files = self.load(key)
+
+        if files is None:
+
+            format = imageformat.identify(path)
+            if not self.readers.has_key(format):
+                raise CacheError, "Unknown image format: %s" % path
+
+            files = self.readers[format](path, format)
+            self.store(key, files)
+            self.evict()
+
+        return files
+
+    def load(self, key):
+
+        """Returns a list of File objects for the entry with the given key, or
+        None if there is no entry for the key. The data of each file refers to
+        the memory mapped entry."""
+
+        path = os.path.join(self.directory, key)
+
+        try:
+            f = open(path, "rb")
+        except IOError:
+            return None
+
+        try:
+            data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        magic, version, count, data_offset = self.header.unpack_from(data, 0)
+
+        if magic != self.magic or version != self.version:
+            raise CacheError, "Invalid cache entry: %s" % path
+
+        files = []
+        p = self.header.size
+
+        for i in range(count):
+
+            load, exec_, offset, length, name_length = self.entry.unpack_from(data, p)
+            p += self.entry.size
+            name = data[p:p + name_length]
+            p += name_length
+
+            files.append(File(name, buffer(data, data_offset + offset, length),
+                              load, exec_, length))
+
+        # Record the use of the entry so that it is evicted last.
+        os.utime(path, None)
+
+        return files
+
+    def store(self, key, files):
+
+        """Stores the details and data of the list of File objects given in an
+        entry with the specified key."""
+
+        table = []
+        offset = 0
+
+        for file in files:
+
+            table.append(self.entry.pack(file.load_address & 0xffffffff,
+                                         file.execution_address & 0xffffffff,
+                                         offset, len(file.data), len(file.name)))
+            table.append(file.name)
+            offset += len(file.data)
+
+        table = "".join(table)
+
+        # Write the entry to a temporary file and rename it so that incomplete
+        # entries are never read.
+        handle, temp_path = tempfile.mkstemp(dir = self.directory)
+        f = os.fdopen(handle, "wb")
+        f.write(self.header.pack(self.magic, self.version, len(files),
+                                 self.header.size + len(table)))
+        f.write(table)
+
+        for file in files:
+            f.write(file.data)
+
+        f.close()
+        os.rename(temp_path, os.path.join(self.directory, key))
+
+    def evict(self):
+
+        """Removes the least recently used entries until the total size of the
+        entries is no more than the maximum size of the cache."""
+
+        entries = []
+        total = 0
+
+        for name in os.listdir(self.directory):
+
+            path = os.path.join(self.directory, name)
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+
+        for mtime, size, path in entries:
+
+            if total <= self.max_size:
+                break
+
+            os.remove(path)
+            total -= size
@@ -0,0 +1,94 @@
+"""
+levelcodec.py - Pack and unpack rows of five-bit tile values.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import binascii, struct
+
+# Each row contains 32 five-bit values packed into 20 bytes, starting with
+# the least significant bits of the first byte. The bytes are handled in
+# groups of five, each holding eight values, which are read and written as
+# a 32-bit word and a byte.
+row_length = 20
+shifts = (0, 5, 10, 15, 20, 25, 30, 35)
+
+# The lowest bit of each value in up to 32 packed rows treated as a number.
+_low_bits = int("00001" * 32 * 32, 2)
+
+# Formats for the numbers of rows used, created when first needed.
+_formats = {}
+
+def _rows_format(count):
+
+    try:
+        return _formats[count]
+    except KeyError:
+        format = _formats[count] = struct.Struct("<" + "IB" * 4 * count)
+        return format
+
+def read_rows(data, address, count):
+
+    """Returns a list containing a list of 32 values for each of the given
+    number of rows stored at the address given in data."""
+
+    v = _rows_format(count).unpack_from(data, address)
+
+    values = [(n >> s) & 0x1f for n in [a | (b << 32) for a, b in zip(v[0::2], v[1::2])]
+                              for s in shifts]
+
+    return [values[i:i + 32] for i in range(0, count * 32, 32)]
+
+def write_rows(rows):
+
+    """Returns the data for the list of rows given, each containing 32 values,
+    in the format read by read_rows."""
+
+    words = []
+
+    for row in rows:
+
+        # Any bits that overflow a group are combined with the next group,
+        # but are discarded at the end of the row.
+        carry = 0
+
+        for i in 0, 8, 16, 24:
+
+            a, b, c, d, e, f, g, h = row[i:i + 8]
+            n = carry | a | (b << 5) | (c << 10) | (d << 15) | (e << 20) | \
+                (f << 25) | (g << 30) | (h << 35)
+
+            words.append(n & 0xffffffff)
+            words.append((n >> 32) & 0xff)
+            carry = n >> 40
+
+    return _rows_format(len(rows)).pack(*words)
+
+def to_number(data):
+
+    """Returns the data written by write_rows as a little-endian number, with
+    each value occupying five bits, so that groups of rows can be compared
+    with differences."""
+
+    return int(binascii.hexlify(data[::-1]), 16)
+
+def differences(a, b):
+
+    """Returns the number of values that differ between the groups of rows
+    represented by the numbers a and b returned by to_number."""
+
+    # Fold the bits of each value that differs into its lowest bit.
+    x = a ^ b
+    x = (x | (x >> 1) | (x >> 2) | (x >> 3) | (x >> 4)) & _low_bits
+    return bin(x).count("1")
@@ -20,36 +20,120 @@ __date__ = "2014-04-22"
 __version__ = "0.1"
 __license__ = "GNU General Public License (version 3 or later)"
 
-import StringIO
+import StringIO, struct
 from diskutils import Directory, DiskError, File, Utilities
 
+class CatalogueFile(File):
+
+    """file = CatalogueFile(catalogue, name, load_address, execution_address,
+                            length, locked, disk_address)
+    
+    A file found in a catalogue whose data is only read from the disk when its
+    data attribute is first used.
+    """
+    
+    def __init__(self, catalogue, name, load_address, execution_address,
+                       length, locked = False, disk_address = 0):
+    
+        self.catalogue = catalogue
+        self.name = name
+        self.load_address = load_address
+        self.execution_address = execution_address
+        self.length = length
+        self.locked = locked
+        self.disk_address = disk_address
+    
+    def __getattr__(self, name):
+    
+        if name == "data":
+            self.data = self.catalogue._read(self.disk_address, self.length)
+            return self.data
+        
+        raise AttributeError, name
+
+
 class Catalogue(Utilities):
 
-    def __init__(self, file):
+    # The end of the disk title, disk cycle, offset of the last entry, boot
+    # option and number of sectors at the start of sector 1
+    header_format = struct.Struct("<4sBBBB")
+    
+    # The name and directory of an entry in sector 0
+    name_format = struct.Struct("<7sB")
+    
+    # The load and execution addresses, length, extra bits and start sector of
+    # an entry in sector 1
+    address_format = struct.Struct("<HHHBB")
+    
+    def __init__(self, file, sectors = 800):
     
         self.file = file
         self.sector_size = 256
         
-        # The free space map initially contains all the space after the
-        # catalogue.
-        self.free_space = [(2, 798)]
-        self.sectors = 800
+        self.sectors = sectors
         self.disk_cycle = 0
         self.boot_option = 0
+        
+        # Initially, only the catalogue sectors are used.
+        self.sector_map = self._new_sector_map()
+    
+    def _new_sector_map(self):
+    
+        # Each byte in the map is non-zero if the corresponding sector is used.
+        sector_map = bytearray(self.sectors)
+        sector_map[:2] = "\x01" * 2
+        return sector_map
     
     def read_free_space(self):
     
         # Using notes from http://mdfs.net/Docs/Comp/Disk/Format/DFS
         
-        self.free_space = []
+        # Mark the sectors used by the files in the catalogue.
+        disk_title, files = self.read()
+        self.sector_map = self._new_sector_map()
+        
+        for file in files:
+            self.reserve(file.disk_address / self.sector_size, self._sectors_needed(file.length))
+        
+        return disk_title, files
+    
+    def free_space(self):
+    
+        """Returns a list of (sector, length) tuples describing the runs of free
+        sectors on the disk."""
+        
+        runs = []
+        start = self.sector_map.find("\x00")
+        
+        while start != -1:
+        
+            end = self.sector_map.find("\x01", start)
+            if end == -1:
+                end = len(self.sector_map)
+            
+            runs.append((start, end - start))
+            start = self.sector_map.find("\x00", end)
+        
+        return runs
+    
+    def reserve(self, sector, length):
+    
+        """Marks the run of sectors starting at the sector given as used, so
+        that files are not placed there when the catalogue is written."""
+        
+        end = min(sector + length, len(self.sector_map))
+        if end > sector:
+            self.sector_map[sector:end] = "\x01" * (end - sector)
     
     def read(self):
     
-        disk_title = self._read(0, 8) + self._read(0x100, 4)
-        self.disk_cycle = self._read_unsigned_byte(self._read(0x104, 1))
-        last_entry = self._read_unsigned_byte(self._read(0x105, 1))
-        extra = self._read_unsigned_byte(self._read(0x106, 1))
-        sectors = self._read_unsigned_byte(self._read(0x107, 1))
+        # Read both catalogue sectors at once.
+        catalogue = self._read(0, 0x200)
+        
+        title_end, self.disk_cycle, last_entry, extra, sectors = \
+            self.header_format.unpack_from(catalogue, 0x100)
+        
+        disk_title = catalogue[:8] + title_end
         self.sectors = sectors | ((extra & 0x03) << 8)
         self.boot_option = (extra & 0x30) >> 4
         
@@ -58,20 +142,17 @@ class Catalogue(Utilities):
         
         while p <= last_entry:
         
-            name = self._read(p, 7)
+            name, extra = self.name_format.unpack_from(catalogue, p)
             if name[0] == "\x00":
                 break
             
             name = name.strip()
-            extra = self._read_unsigned_byte(self._read(p + 7))
             prefix = chr(extra & 0x7f)
             locked = (extra & 0x80) != 0
             
-            load = self._read_unsigned_half_word(self._read(0x100 + p, 2))
-            exec_ = self._read_unsigned_half_word(self._read(0x100 + p + 2, 2))
-            length = self._read_unsigned_half_word(self._read(0x100 + p + 4, 2))
+            load, exec_, length, extra, file_start_sector = \
+                self.address_format.unpack_from(catalogue, 0x100 + p)
             
-            extra = self._read_unsigned_byte(self._read(0x100 + p + 6))
             load = load | ((extra & 0x0c) << 14)
             length = length | ((extra & 0x30) << 12)
             exec_ = exec_ | ((extra & 0xc0) << 10)
@@ -81,101 +162,336 @@ class Catalogue(Utilities):
             if exec_ & 0x30000 == 0x30000:
                 exec_ = exec_ | 0xfc0000
             
-            file_start_sector = self._read_unsigned_byte(self._read(0x100 + p + 7))
             file_start_sector = file_start_sector | ((extra & 0x03) << 8)
             
-            data = self._read(file_start_sector * self.sector_size, length)
-            
-            files.append(File(prefix + "." + name, data, load, exec_, length, locked,
-                              file_start_sector * self.sector_size))
+            # The file data is read when it is needed.
+            files.append(CatalogueFile(self, prefix + "." + name, load, exec_, length, locked,
+                                       file_start_sector * self.sector_size))
             
             p += 8
         
         return disk_title, files
     
-    def write(self, disk_title, files):
+    def write(self, disk_title, files, placement = "first"):
     
+        # Files are placed in the free space using one of the following
+        # strategies:
+        #   "first"    place each file in the first space large enough for
+        #              it, in catalogue order
+        #   "best"     place each file in the smallest space large enough for
+        #              it, in catalogue order
+        #   "compact"  place the largest files first, each in the smallest
+        #              space large enough for it
+        
+        # Read the data of any files that have not been read yet, since the
+        # new catalogue and file data may overwrite it.
+        for file in files:
+            file.data
+        
         if len(files) > 31:
             raise DiskError, "Too many entries to write."
         
-        disk_name = self._pad(self._safe(disk_title), 12, " ")
-        self._write(0, disk_title[:8])
-        self._write(0x100, disk_title[8:12])
+        # Allocate space for all the files before writing anything.
+        disk_addresses = self._allocate(files, placement)
+        
+        # Read both catalogue sectors into a buffer, update it in place and
+        # write it back after the file data.
+        catalogue = self._read_buffer(0, 0x200)
+        
+        title = disk_title[:12]
+        catalogue[:len(title[:8])] = title[:8]
+        catalogue[0x100:0x100 + len(title[8:])] = title[8:]
         
         # Write the number of files and the disk cycle.
-        self.disk_cycle += 1
-        self._write(0x104, self._write_unsigned_byte(self.disk_cycle))
-        self._write(0x105, self._write_unsigned_byte(len(files) * 8))
+        self.disk_cycle = (self.disk_cycle + 1) & 0xff
+        self._write_unsigned_byte(self.disk_cycle, catalogue, 0x104)
+        self._write_unsigned_byte(len(files) * 8, catalogue, 0x105)
         
         extra = (self.sectors >> 8) & 0x03
         extra = extra | (self.boot_option << 4)
-        self._write(0x106, self._write_unsigned_byte(extra))
-        self._write(0x107, self._write_unsigned_byte(self.sectors & 0xff))
+        self._write_unsigned_byte(extra, catalogue, 0x106)
+        self._write_unsigned_byte(self.sectors & 0xff, catalogue, 0x107)
         
         p = 8
-        for file in files:
+        for file, disk_address in zip(files, disk_addresses):
+        
+            self._pack_entry(file, disk_address / self.sector_size, catalogue, p)
+            self._write(disk_address, file.data)
+            p += 8
+        
+        self._write(0, str(catalogue))
+    
+    def patch(self, files, dry_run = False):
+    
+        """Updates the files on the disk in place, writing only the sectors
+        that differ from those on the disk. The files must have the same names
+        as those in the catalogue, in the same order, and each must still fit
+        in the space it occupies. Returns a list of (sector, number of sectors)
+        tuples describing the sectors that were changed, or that would be
+        changed if dry_run is True."""
         
-            prefix, name = file.name.split(".")
-            name = self._pad(name, 7, " ")
-            self._write(p, name)
+        # Find the sectors used by the files on the disk.
+        disk_title, old_files = self.read_free_space()
+        
+        if len(files) != len(old_files):
+            raise DiskError, "The number of files differs from the catalogue."
+        
+        # Pack the new catalogue entries into a copy of the catalogue sectors
+        # so that they can be compared with the existing ones.
+        catalogue = self._read_buffer(0, 0x200)
+        new_catalogue = bytearray(catalogue)
+        
+        writes = []
+        entries_changed = False
+        p = 8
+        
+        for file, old_file in zip(files, old_files):
+        
+            if file.name != old_file.name:
+                raise DiskError, "File %s does not match the catalogue entry %s." % (file.name, old_file.name)
             
-            extra = ord(prefix)
-            if file.locked:
-                extra = extra | 128
+            start = old_file.disk_address / self.sector_size
+            old_sectors = self._sectors_needed(old_file.length)
+            sectors = self._sectors_needed(file.length)
             
-            self._write(p + 7, self._write_unsigned_byte(extra))
+            # Check that any extra sectors needed by the file are free.
+            if sectors > old_sectors and (start + sectors > self.sectors or \
+                self.sector_map.find("\x01", start + old_sectors, start + sectors) != -1):
+                raise DiskError, "File %s does not fit in its space on the disk." % file.name
             
-            load = file.load_address
-            exec_ = file.execution_address
-            length = file.length
+            # Compare the file data with the data on the disk a sector at a
+            # time, only writing the sectors that differ.
+            data = file.data
+            old_data = old_file.data
             
-            self._write(0x100 + p, self._write_unsigned_half_word(load & 0xffff))
-            self._write(0x100 + p + 2, self._write_unsigned_half_word(exec_ & 0xffff))
-            self._write(0x100 + p + 4, self._write_unsigned_half_word(length & 0xffff))
+            for offset in range(0, len(data), self.sector_size):
             
-            disk_address = self._find_space(file)
-            file_start_sector = disk_address / self.sector_size
-            self._write(disk_address, file.data)
+                piece = data[offset:offset + self.sector_size]
+                if piece != old_data[offset:offset + len(piece)]:
+                    writes.append((old_file.disk_address + offset, piece))
             
-            extra = ((file_start_sector >> 8) & 0x03)
-            extra = extra | ((load >> 14) & 0x0c)
-            extra = extra | ((exec_ >> 12) & 0x30)
-            extra = extra | ((length >> 10) & 0xc0)
+            # Only write catalogue entries that differ from the existing ones.
+            self._pack_entry(file, start, new_catalogue, p)
             
-            self._write(0x100 + p + 6, self._write_unsigned_byte(extra))
-            self._write(0x100 + p + 7, self._write_unsigned_byte(file_start_sector & 0xff))
+            for offset in p, 0x100 + p:
+                if new_catalogue[offset:offset + 8] != catalogue[offset:offset + 8]:
+                    writes.append((offset, str(new_catalogue[offset:offset + 8])))
+                    entries_changed = True
             
             p += 8
+        
+        if entries_changed:
+            self.disk_cycle = (self.disk_cycle + 1) & 0xff
+            writes.append((0x104, self._write_unsigned_byte(self.disk_cycle)))
+        
+        # Find the ranges of sectors that are changed.
+        dirty = []
+        for offset, data in sorted(writes):
+        
+            first = offset / self.sector_size
+            last = (offset + len(data) - 1) / self.sector_size
+            
+            if dirty and first <= dirty[-1][0] + dirty[-1][1]:
+                start, length = dirty[-1]
+                dirty[-1] = (start, max(length, last + 1 - start))
+            else:
+                dirty.append((first, last + 1 - first))
+        
+        if not dry_run:
+        
+            # Check that the changes are all within the disk image, finding
+            # the offsets in the whole image for sides of double-sided disks.
+            if isinstance(self.file, Side):
+                image = self.file.file
+                image_offset = self.file.image_offset
+            else:
+                image = self.file
+                image_offset = lambda offset: offset
+            
+            image.seek(0, 2)
+            size = image.tell()
+            
+            for offset, data in writes:
+                if image_offset(offset + len(data) - 1) >= size:
+                    raise DiskError, "The disk image is too short to be updated in place."
+            
+            for offset, data in writes:
+                self._write(offset, data)
+        
+        return dirty
     
-    def _find_space(self, file):
+    def _pack_entry(self, file, file_start_sector, catalogue, p):
     
-        for i in range(len(self.free_space)):
+        # Pack the entries for the file into the buffer containing the first
+        # and second catalogue sectors at the offset given.
+        prefix, name = file.name.split(".")
         
-            sector, length = self.free_space[i]
-            file_length = file.length/self.sector_size
-            
-            if file.length % self.sector_size != 0:
-                file_length += 1
+        extra = ord(prefix)
+        if file.locked:
+            extra = extra | 128
+        
+        self.name_format.pack_into(catalogue, p, self._pad(name, 7, " "), extra)
+        
+        load = file.load_address
+        exec_ = file.execution_address
+        length = file.length
+        
+        extra = ((file_start_sector >> 8) & 0x03)
+        extra = extra | ((load >> 14) & 0x0c)
+        extra = extra | ((length >> 12) & 0x30)
+        extra = extra | ((exec_ >> 10) & 0xc0)
+        
+        self.address_format.pack_into(catalogue, 0x100 + p, load & 0xffff,
+            exec_ & 0xffff, length & 0xffff, extra, file_start_sector & 0xff)
+    
+    def defragment(self):
+    
+        """Rewrites the files on the disk so that they occupy a single run of
+        sectors after the catalogue, leaving all the free space at the end of
+        the disk."""
+        
+        disk_title, files = self.read()
+        self.sector_map = self._new_sector_map()
+        self.write(disk_title, files)
+    
+    def _sectors_needed(self, length):
+    
+        sectors = length / self.sector_size
+        if length % self.sector_size != 0:
+            sectors += 1
+        
+        return sectors
+    
+    def _allocate(self, files, placement):
+    
+        if placement == "compact":
+            # Allocate space for the largest files first.
+            order = sorted(range(len(files)), key = lambda i: -files[i].length)
+            placement = "best"
+        elif placement in ("first", "best"):
+            order = range(len(files))
+        else:
+            raise DiskError, "Unknown placement strategy: %s" % placement
+        
+        disk_addresses = [None] * len(files)
+        
+        for i in order:
+            disk_addresses[i] = self._find_space(files[i], placement)
+        
+        return disk_addresses
+    
+    def _find_space(self, file, placement = "first"):
+    
+        file_length = self._sectors_needed(file.length)
+        runs = filter(lambda run: run[1] >= file_length, self.free_space())
+        
+        if not runs:
+            raise DiskError, "Failed to find space for file: %s" % file.name
+        
+        if placement == "best":
+            sector, length = min(runs, key = lambda run: (run[1], run[0]))
+        else:
+            sector, length = runs[0]
+        
+        self.reserve(sector, file_length)
+        return sector * self.sector_size
+
+
+class Side:
+
+    """side = Side(file, track_offsets, track_size)
+    
+    Present one side of an interleaved double-sided disk image as a file
+    object. Offsets on the side are translated to offsets in the image using
+    the list of offsets of the side's tracks in the image.
+    """
+    
+    def __init__(self, file, track_offsets, track_size):
+    
+        self.file = file
+        self.track_offsets = track_offsets
+        self.track_size = track_size
+        self.size = len(track_offsets) * track_size
+        self.ptr = 0
+    
+    def seek(self, offset, whence = 0):
+    
+        if whence == 0:
+            self.ptr = offset
+        elif whence == 1:
+            self.ptr += offset
+        else:
+            self.ptr = self.size + offset
+    
+    def tell(self):
+    
+        return self.ptr
+    
+    def image_offset(self, offset):
+    
+        """Returns the offset in the whole image corresponding to the offset
+        on the side given."""
+        
+        track, offset = divmod(offset, self.track_size)
+        if track >= len(self.track_offsets):
+            raise DiskError, "Offset beyond the end of the disk side."
+        
+        return self.track_offsets[track] + offset
+    
+    def read(self, length = -1):
+    
+        if length < 0:
+            end = self.size
+        else:
+            end = min(self.ptr + length, self.size)
+        
+        pieces = []
+        
+        while self.ptr < end:
+        
+            track, offset = divmod(self.ptr, self.track_size)
+            length = min(self.track_size - offset, end - self.ptr)
             
-            if length >= file_length:
+            self.file.seek(self.track_offsets[track] + offset, 0)
+            piece = self.file.read(length)
+            pieces.append(piece)
+            self.ptr += len(piece)
             
-                if length > file_length:
-                    # Update the free space entry to contain the remaining space.
-                    self.free_space[i] = (sector + file_length, length - file_length)
-                else:
-                    # Remove the free space entry.
-                    del self.free_space[i]
-                
-                return sector * self.sector_size
+            # Stop at the end of a truncated image.
+            if len(piece) < length:
+                break
+        
+        return "".join(pieces)
+    
+    def write(self, data):
+    
+        i = 0
         
-        raise DiskError, "Failed to find space for file: %s" % file.name
+        while i < len(data):
+        
+            track, offset = divmod(self.ptr, self.track_size)
+            if track >= len(self.track_offsets):
+                raise DiskError, "Write beyond the end of the disk side."
+            
+            length = min(self.track_size - offset, len(data) - i)
+            
+            self.file.seek(self.track_offsets[track] + offset, 0)
+            self.file.write(data[i:i + length])
+            self.ptr += length
+            i += length
 
 
 class Disk:
 
-    DiskSizes = {None: 200 * 1024}
-    SectorSizes = {None: 256}
-    Catalogues = {None: Catalogue}
+    # Formats: None for 80 track single-sided images, "dsd" for 80 track
+    # interleaved double-sided images and "dsd40" for 40 track interleaved
+    # double-sided images.
+    DiskSizes = {None: 200 * 1024, "dsd": 400 * 1024, "dsd40": 200 * 1024}
+    SectorSizes = {None: 256, "dsd": 256, "dsd40": 256}
+    Catalogues = {None: Catalogue, "dsd": Catalogue, "dsd40": Catalogue}
+    Sides = {None: 1, "dsd": 2, "dsd40": 2}
+    Tracks = {None: 80, "dsd": 80, "dsd40": 40}
+    SectorsPerTrack = 10
     
     def __init__(self, format = None):
     
@@ -186,13 +502,40 @@ class Disk:
         self.size = self.DiskSizes[self.format]
         self.data = "\x00" * self.size
         self.file = StringIO.StringIO(self.data)
+        self._make_interleave()
     
     def open(self, file_object):
     
         self.size = self.DiskSizes[self.format]
         self.file = file_object
+        self._make_interleave()
+    
+    def _make_interleave(self):
+    
+        # Record the offset in the image of each track on each side. Tracks
+        # from each side alternate in double-sided images.
+        sides = self.Sides[self.format]
+        self.track_size = self.SectorsPerTrack * self.SectorSizes[self.format]
+        self.interleave = []
+        
+        for side in range(sides):
+            self.interleave.append(map(lambda track: (track * sides + side) * self.track_size,
+                                       range(self.Tracks[self.format])))
+    
+    def side(self, side = 0):
+    
+        if not 0 <= side < self.Sides[self.format]:
+            raise DiskError, "No side %i on this disk." % side
+        
+        if self.Sides[self.format] == 1:
+            return self.file
+        
+        return Side(self.file, self.interleave[side], self.track_size)
     
-    def catalogue(self):
+    def catalogue(self, side = 0):
     
+        # The catalogue for each side is only read when its read method is
+        # called.
         sector_size = self.SectorSizes[self.format]
-        return self.Catalogues[self.format](self.file)
+        sectors = self.Tracks[self.format] * self.SectorsPerTrack
+        return self.Catalogues[self.format](self.side(side), sectors)
@@ -19,8 +19,13 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 __all__ = ["sprites"]
 
+import mmap, os, shutil
+
 import UEFfile
+import imageformat
+import levelcodec
 import makedfs
+import scrambling
 
 from Repton.sprites import Reader, BBCReader
 
@@ -38,14 +43,20 @@ class Repton:
     
     def __init__(self, uef_or_ssd_file):
     
-        if uef_or_ssd_file.endswith("uef"):
+        # Identify the image from its contents rather than its name.
+        format = imageformat.identify(uef_or_ssd_file)
+        
+        if format in (imageformat.UEF, imageformat.GZIP_UEF):
         
             # Acorn Electron version
             
-            self.uef = UEFfile.UEFfile(uef_or_ssd_file)
+            self.uef = UEFfile.UEFfile(uef_or_ssd_file, lazy = True)
             self.file_number = 0
             
-            for details in self.uef.contents:
+            # Only decode the blocks of the file containing the levels.
+            members = self.uef.iter_members()
+            
+            for details in members:
             
                 if details["name"] == b"REPTON2":
                     break
@@ -54,14 +65,18 @@ class Repton:
             else:
                 raise NotFound
             
-            self.data = details["data"]
+            self.data = self.uef.read_member(details)
             
             if len(self.data) != 0x4a00:
                 raise IncorrectSize
             
             # Certain releases of Repton contain scrambled data. Unscramble it
-            # using a reversible scrambling routine.
-            if len(self.uef.contents) == 4:
+            # using a reversible scrambling routine. The same decision is used
+            # when the data is saved.
+            self.file_count = self.file_number + 1 + len(list(members))
+            self.scrambled = self.file_count == 4
+            
+            if self.scrambled:
                 self.data = self.scramble(self.data)
             
             self.levels_start = 0x2c00
@@ -74,23 +89,25 @@ class Repton:
             self.tile_width = 8
             self.tile_height = 16
         
-        elif uef_or_ssd_file.endswith("ssd"):
+        elif format in imageformat.dfs_formats:
         
             # BBC Micro DFS disk version
             
-            self.ssd = makedfs.Disk()
-            self.ssd.open(open(uef_or_ssd_file))
-            self.file_number = 0
-            
-            cat = self.ssd.catalogue()
-            title, files = cat.read()
+            self.ssd_path = uef_or_ssd_file
+            self.ssd = makedfs.Disk(imageformat.dfs_formats[format])
+            self.ssd.open(open(uef_or_ssd_file, "rb"))
             
-            for details in files:
+            # Find the side of the disk containing the levels.
+            for self.side in range(self.ssd.Sides[self.ssd.format]):
             
-                if details.name == b"D.REPTON2":
-                    break
+                cat = self.ssd.catalogue(self.side)
+                title, files = cat.read()
+                names = [details.name for details in files]
                 
-                self.file_number += 1
+                if b"D.REPTON2" in names:
+                    self.file_number = names.index(b"D.REPTON2")
+                    details = files[self.file_number]
+                    break
             else:
                 raise NotFound
             
@@ -115,90 +132,27 @@ class Repton:
     def scramble(self, data):
     
         # Keep the first byte.
-        s = data[:1]
-        
-        d = []
-        v = 0xe0
-        o = [0x05, 0x04, 0x07, 0x06, 0x01, 0x00, 0x03, 0x02,
-             0x0d, 0x0c, 0x0f, 0x0e, 0x09, 0x08, 0x0b, 0x0a,
-             0x15, 0x14, 0x17, 0x16, 0x11, 0x10, 0x13, 0x12,
-             0x1d, 0x1c, 0x1f, 0x1e, 0x19, 0x18, 0x1b, 0x1a]
-        i = 0
-        while i < len(data):
-        
-            b = data[i:i+32]
-            j = 0
-            while j < 32:
-                d.append(b[j] ^ (v + o[j]))
-                j += 1
-            
-            if v == 0:
-                v = 0xe0
-            else:
-                v -= 32
-            
-            i += 32
-        
-        return s + bytes(d[1:])
+        return data[:1] + scrambling.repton.apply(data[1:], 1)
     
     def read_levels(self):
     
         levels = []
         
+        # Each level contains 32 rows of 32 five-bit values.
         for number in range(12):
         
             address = self.levels_start + (number * 640)
-            level = []
-    
-            for row in range(32):
-    
-                current = 0
-                offset = 0
-                level.append([])
-    
-                for column in range(32):
-    
-                    if offset < 5:
-                        ch = self.data[address]
-                        current = current | (ch << offset)
-                        address += 1
-                        offset += 8
-    
-                    if offset >= 5:
-                        value = current & 0x1f
-                        current = current >> 5
-                        offset -= 5
-                        level[-1].append(value)
-            
-            levels.append(level)
+            levels.append(levelcodec.read_rows(self.data, address, 32))
         
         return levels
     
     def write_levels(self, levels):
     
-        data = self.data[:self.levels_start]
+        rows = []
+        for level in levels:
+            rows += level[:32]
         
-        for number in range(len(levels)):
-        
-            level = levels[number]
-            
-            for row in range(32):
-            
-                current = 0
-                offset = 0
-                
-                for column in range(32):
-                
-                    if offset < 8:
-                        current = current | (level[row][column] << offset)
-                        offset += 5
-                    
-                    if offset >= 8:
-                        data += bytes([current & 0xff])
-                        current = current >> 8
-                        offset -= 8
-        
-        self.data = data
+        self.data = self.data[:self.levels_start] + levelcodec.write_rows(rows)
     
     def read_sprites(self):
     
@@ -220,18 +174,24 @@ class Repton:
     
         # Update the UEF file and save it to the specified location.
         
-        # Scramble the data if necessary.
-        if len(self.uef.contents) == 4:
-            self.data = self.scramble(self.data)
+        # Scramble the data if necessary, leaving the unscrambled data in
+        # place for later edits.
+        if self.scrambled:
+            data = self.scramble(self.data)
+        else:
+            data = self.data
         
         last_file = self.uef.contents[-1]
         last_index = len(self.uef.contents) - 1
         
+        # Replace the file, rebuilding the list of chunks only once.
+        self.uef.begin_edit()
         self.uef.remove_files([last_index])
         
         # Add the last file again with the updated level data.
-        info = (last_file["name"], last_file["load"], last_file["exec"], self.data)
+        info = (last_file["name"], last_file["load"], last_file["exec"], data)
         self.uef.import_files(last_index, info)
+        self.uef.end_edit()
         
         try:
             self.uef.write(path, write_emulator_info = False)
@@ -241,13 +201,79 @@ class Repton:
     
     def saveSSD(self, path):
     
+        # Update the level data in a copy of the original SSD file, or in the
+        # original file itself, only writing the sectors that have changed.
+        try:
+            if not os.path.exists(path) or not os.path.samefile(path, self.ssd_path):
+                shutil.copyfile(self.ssd_path, path)
+            
+            f = open(path, "r+b")
+            try:
+                data = mmap.mmap(f.fileno(), 0)
+                try:
+                    disk = makedfs.Disk(self.ssd.format)
+                    disk.open(data)
+                    catalogue = disk.catalogue(self.side)
+                    
+                    title, files = catalogue.read()
+                    files[self.file_number].data = self.data
+                    
+                    # Fix copy protection length problem.
+                    for file in files:
+                        file.length = len(file.data)
+                    
+                    catalogue.patch(files)
+                    data.flush()
+                finally:
+                    data.close()
+            finally:
+                f.close()
+            
+            return True
+        
+        except makedfs.DiskError:
+            # The disk cannot be updated in place, so write a new one.
+            try:
+                return self.rebuildSSD(path)
+            except makedfs.DiskError:
+                return False
+        
+        except EnvironmentError:
+            return False
+    
+    def rebuildSSD(self, path):
+    
         # Write the new SSD file.
-        disk = makedfs.Disk()
+        disk = makedfs.Disk(self.ssd.format)
         disk.new()
-        catalogue = disk.catalogue()
+        
+        # Copy the files on the other sides of double-sided disks.
+        for side in range(self.ssd.Sides[self.ssd.format]):
+        
+            if side != self.side:
+            
+                # Copy unformatted sides unchanged instead of reading files
+                # from their catalogues.
+                old_side = self.ssd.side(side)
+                old_side.seek(0, 0)
+                
+                if imageformat.dfs_sectors(old_side.read(0x200), 0) is None:
+                    old_side.seek(0, 0)
+                    new_side = disk.side(side)
+                    new_side.seek(0, 0)
+                    new_side.write(old_side.read())
+                    continue
+                
+                old_catalogue = self.ssd.catalogue(side)
+                title, files = old_catalogue.read()
+                catalogue = disk.catalogue(side)
+                catalogue.boot_option = old_catalogue.boot_option
+                catalogue.write(title, files)
+        
+        catalogue = disk.catalogue(self.side)
         catalogue.boot_option = 3
         
-        title, files = self.ssd.catalogue().read()
+        title, files = self.ssd.catalogue(self.side).read()
         
         # Update the level data.
         files[self.file_number].data = self.data
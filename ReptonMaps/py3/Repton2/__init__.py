@@ -20,6 +20,8 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 __all__ = ["sprites"]
 
 import UEFfile
+import imageformat
+import levelcodec
 import makedfs
 
 from Repton2.sprites import Reader
@@ -31,7 +33,24 @@ class IncorrectSize(Exception):
     pass
 
 class TooManyAreas(Exception):
-    pass
+
+    def __init__(self, needed, available, suggestions):
+    
+        Exception.__init__(self, needed, available, suggestions)
+        self.needed = needed
+        self.available = available
+        self.suggestions = suggestions
+    
+    def __str__(self):
+    
+        lines = ["The levels need %i areas but only %i can be stored." % (
+                 self.needed, self.available)]
+        
+        if self.suggestions:
+            lines.append("The following changes would reduce the number needed:")
+            lines += self.suggestions
+        
+        return "\n".join(lines)
 
 class Repton2:
 
@@ -50,9 +69,21 @@ class Repton2:
     
     scores = {3: 3, 4: 4, 5: 5, 6: 6}
     
+    # Each level is stored as four areas of eight rows. Areas filled with a
+    # single tile are referred to by the tile number with the top bit set,
+    # and other areas are stored once in the space available for them.
+    area_rows = 8
+    max_areas = 0x30
+    
+    uniform_areas = dict(map(lambda tile: (levelcodec.write_rows([[tile] * 32] * 8), tile),
+                             range(32)))
+    
     def __init__(self, uef_or_ssd_file):
     
-        if uef_or_ssd_file.endswith("uef"):
+        # Identify the image from its contents rather than its name.
+        format = imageformat.identify(uef_or_ssd_file)
+        
+        if format in (imageformat.UEF, imageformat.GZIP_UEF):
         
             # Acorn Electron version
             
@@ -80,22 +111,24 @@ class Repton2:
             
             self.version = "Electron"
         
-        elif uef_or_ssd_file.endswith("ssd"):
+        elif format in imageformat.dfs_formats:
         
             # BBC Micro DFS disk version
             
-            self.ssd = makedfs.Disk()
-            self.ssd.open(open(uef_or_ssd_file))
-            self.file_number = 0
+            self.ssd = makedfs.Disk(imageformat.dfs_formats[format])
+            self.ssd.open(open(uef_or_ssd_file, "rb"))
             
-            cat = self.ssd.catalogue()
-            title, contents = cat.read()
+            # Find the side of the disk containing the levels.
+            for self.side in range(self.ssd.Sides[self.ssd.format]):
             
-            for details in contents:
-                if details.name == b"D.REPB":
-                    break
+                cat = self.ssd.catalogue(self.side)
+                title, contents = cat.read()
+                names = [details.name for details in contents]
                 
-                self.file_number += 1
+                if b"D.REPB" in names:
+                    self.file_number = names.index(b"D.REPB")
+                    details = contents[self.file_number]
+                    break
             else:
                 raise NotFound
             
@@ -138,26 +171,7 @@ class Repton2:
                 
                 else:
                     address = self.levels_start + (offset * 160)
-                    
-                    for row in range(8):
-                    
-                        current = 0
-                        offset = 0
-                        level.append([])
-                        
-                        for column in range(32):
-            
-                            if offset < 5:
-                                ch = self.data[address]
-                                current = current | (ch << offset)
-                                address += 1
-                                offset += 8
-            
-                            if offset >= 5:
-                                value = current & 0x1f
-                                current = current >> 5
-                                offset -= 5
-                                level[-1].append(value)
+                    level += levelcodec.read_rows(self.data, address, 8)
             
             levels.append(level)
         
@@ -268,42 +282,48 @@ class Repton2:
     
     def recalculateTotals(self, levels, transporters, pieces):
     
+        return self.totals_from_counts([self.count_tiles(level) for level in levels], transporters, pieces)
+    
+    def count_tiles(self, level):
+    
+        """Returns a list containing the number of times each tile occurs in
+        the level given."""
+        
+        counts = [0] * 32
+        
+        for row in level:
+            for cell in row:
+                counts[cell] += 1
+        
+        return counts
+    
+    def totals_from_counts(self, counts, transporters, pieces):
+    
+        """Returns the totals for diamonds, earth, monsters, transporters and
+        puzzle pieces using the lists of tile counts for each level returned
+        by count_tiles. The lists can be kept up to date as tiles are changed
+        so that the levels themselves do not need to be examined."""
+        
         diamonds = 0
         earth = 0
         monsters = 0
         transporters_total = 0
         
-        for i in range(len(levels)):
+        for i in range(len(counts)):
         
-            level = levels[i]
+            level_counts = counts[i]
             
-            safes = 0
-            spirits = 0
-            cages = 0
-            keys = 0
-            
-            for row in level:
-                for cell in row:
-                
-                    if 3 <= cell <= 5:
-                        earth += 1
-                    elif cell == 6:
-                        diamonds += 1
-                    elif cell == 15:
-                        monsters += 1
-                    elif cell == 7:
-                        keys += 1
-                    elif cell == 9:
-                        spirits += 1
-                    elif cell == 12:
-                        cages += 1
-                    elif cell == 13:
-                        safes += 1
+            earth += level_counts[3] + level_counts[4] + level_counts[5]
+            diamonds += level_counts[6]
+            monsters += level_counts[15]
             
-            if keys > 0:
-                diamonds += safes
+            # Safes contain diamonds if there are keys to open them, and
+            # spirits in cages are turned into diamonds on all screens except
+            # the first.
+            if level_counts[7] > 0:
+                diamonds += level_counts[13]
             if i != 0:
-                diamonds += min(spirits, cages)
+                diamonds += min(level_counts[9], level_counts[12])
         
         for screen, defs in transporters.items():
         
@@ -378,89 +398,127 @@ class Repton2:
         
         # Level area definitions
         
-        # Find filled areas.
+        areas, area_data = self.pack_areas(levels)
+        
+        if len(area_data) > self.max_areas:
+            raise TooManyAreas(len(area_data), self.max_areas,
+                               self.suggest_area_edits(areas, area_data))
+        
+        data += bytes(areas)
+        
+        # Text character definitions
+        data += old_data[0x2040:0x2340]
+        
+        # Sprite definitions
+        data += old_data[0x2340:0x2e00]
+        
+        # Level definitions, each only stored for the first area that uses it
+        data += b"".join(area_data)
+        
+        # Fill the rest of the level data with null bytes.
+        data += (0x4c00 - len(data)) * b"\x00"
+        
+        self.uef.contents[self.file_number]["data"] = data
+    
+    def pack_areas(self, levels):
+    
+        """Returns a list containing a reference for each area of the levels
+        given and a list containing the packed data for each area referenced
+        by number, in the order they are first used."""
+        
         area_dict = {}
         areas = []
+        area_data = []
         
-        a = 0
         for level in levels:
         
-            for row in range(0, 32, 8):
-                area = []
-                for row in level[row:row+8]:
-                    area += row
-                
-                area = tuple(area)
+            for row in range(0, 32, self.area_rows):
+            
+                # The packed data for each area is used to find areas that
+                # have already been seen, including those filled with one tile.
+                data = levelcodec.write_rows(level[row:row + self.area_rows])
                 
-                # Reference existing areas if possible.
                 try:
-                    areas.append(area_dict[area])
-                    continue
+                    areas.append(area_dict[data])
                 except KeyError:
-                    pass
-                
-                # Determine if the area is completely filled with one tile type.
-                first_tile = area[0]
-                for tile in area:
-                    if tile != first_tile:
-                        area_dict[area] = a
-                        areas.append(a)
-                        a += 1
-                        break
-                else:
-                    # Reference special tile-filled areas.
-                    areas.append(0x80 | first_tile)
-        
-        if a > 0x30:
-            print(list(map(hex, areas)))
-            raise TooManyAreas
+                    if data in self.uniform_areas:
+                        area_dict[data] = 0x80 | self.uniform_areas[data]
+                    else:
+                        area_dict[data] = len(area_data)
+                        area_data.append(data)
+                    
+                    areas.append(area_dict[data])
         
-        data += bytes(areas)
+        return areas, area_data
+    
+    def suggest_area_edits(self, areas, area_data):
+    
+        """Returns a list of descriptions of changes to the areas that would
+        remove enough stored areas to fit the rest in the space available,
+        using the references and data returned by pack_areas, with the
+        changes affecting the fewest tiles first."""
         
-        # Text character definitions
-        data += old_data[0x2040:0x2340]
+        # Record the screens and rows where each stored area is used.
+        uses = [[] for data in area_data]
+        for i in range(len(areas)):
+            if areas[i] & 0x80 == 0:
+                uses[areas[i]].append((i // 4, (i % 4) * self.area_rows))
         
-        # Sprite definitions
-        data += old_data[0x2340:0x2e00]
+        values = list(map(levelcodec.to_number, area_data))
+        uniform_values = [(levelcodec.to_number(data), tile)
+                          for data, tile in self.uniform_areas.items()]
         
-        # Level definitions
-        next = 0
+        # Each stored area can be removed by filling it with a single tile or
+        # by making it the same as another stored area. The cost of a change
+        # is the number of tiles changed in all the places the area is used.
+        changes = []
         
-        for a in range(len(areas)):
+        for i in range(len(values)):
         
-            if a % 4 == 0:
-                level = levels[a//4]
+            count, tile = min((levelcodec.differences(values[i], value), tile)
+                              for value, tile in uniform_values)
+            changes.append((count * len(uses[i]), i, None, tile))
             
-            area = areas[a]
+            for j in range(i + 1, len(values)):
             
-            # If the area is a special area or refers to one that has already
-            # occurred then do not write its data to the file.
-            if area & 0x80 != 0 or area < next:
+                count = levelcodec.differences(values[i], values[j])
+                if len(uses[i]) <= len(uses[j]):
+                    changes.append((count * len(uses[i]), i, j, None))
+                else:
+                    changes.append((count * len(uses[j]), j, i, None))
+        
+        changes.sort(key = lambda change: change[:2])
+        
+        # Areas that others are made to match must be kept.
+        removed = set()
+        kept = set()
+        suggestions = []
+        excess = len(area_data) - self.max_areas
+        
+        for count, i, j, tile in changes:
+        
+            if len(suggestions) == excess:
+                break
+            elif i in removed or i in kept or j in removed:
                 continue
             
-            next = area + 1
-            start_row = (a % 4) * 8
+            removed.add(i)
+            places = self._describe_places(uses[i])
             
-            for row in range(start_row, start_row + 8):
-            
-                current = 0
-                offset = 0
-                
-                for column in range(32):
-                
-                    if offset < 8:
-                        current = current | (level[row][column] << offset)
-                        offset += 5
-                    
-                    if offset >= 8:
-                        data += bytes([current & 0xff])
-                        current = current >> 8
-                        offset -= 8
-        
-        # Fill the rest of the level data with null bytes.
-        data += (0x4c00 - len(data)) * b"\x00"
+            if j is None:
+                suggestions.append("Fill %s with tile %i (%i tiles changed)" % (
+                    places, tile, count))
+            else:
+                kept.add(j)
+                suggestions.append("Make %s match %s (%i tiles changed)" % (
+                    places, self._describe_places(uses[j][:1]), count))
         
-        self.uef.contents[self.file_number]["data"] = data
+        return suggestions
+    
+    def _describe_places(self, places):
+    
+        return " and ".join("Screen %s rows %i-%i" % (
+            chr(65 + screen), row, row + self.area_rows - 1) for screen, row in places)
     
     def bcd(self, value):
     
@@ -26,48 +26,85 @@ class DiskError(Exception):
 
 class Utilities:
 
+    # Precompiled codecs for little endian values
+    signed_word = struct.Struct("<i")
+    unsigned_word = struct.Struct("<I")
+    signed_byte = struct.Struct("<b")
+    unsigned_byte = struct.Struct("<B")
+    unsigned_half_word = struct.Struct("<H")
+    signed_half_word = struct.Struct("<h")
+    
+    # Codecs for unsigned values of the sizes handled directly by _str2num
+    # and _num2str
+    unsigned_codecs = {1: unsigned_byte, 2: unsigned_half_word,
+                       4: unsigned_word, 8: struct.Struct("<Q")}
+    
     # Little endian reading
     
-    def _read_signed_word(self, s):
+    # Values are read from strings or from buffers such as bytearrays and
+    # memoryviews at the offset given, without copying them first.
+    
+    def _read_signed_word(self, s, offset = 0):
     
-        return struct.unpack("<i", s)[0]
+        return self.signed_word.unpack_from(s, offset)[0]
     
-    def _read_unsigned_word(self, s):
+    def _read_unsigned_word(self, s, offset = 0):
     
-        return struct.unpack("<I", s)[0]
+        return self.unsigned_word.unpack_from(s, offset)[0]
     
-    def _read_signed_byte(self, s):
+    def _read_signed_byte(self, s, offset = 0):
     
-        return struct.unpack("<b", s)[0]
+        return self.signed_byte.unpack_from(s, offset)[0]
     
-    def _read_unsigned_byte(self, s):
+    def _read_unsigned_byte(self, s, offset = 0):
     
-        return struct.unpack("<B", s)[0]
+        return self.unsigned_byte.unpack_from(s, offset)[0]
     
-    def _read_unsigned_half_word(self, s):
+    def _read_unsigned_half_word(self, s, offset = 0):
     
-        return struct.unpack("<H", s)[0]
+        return self.unsigned_half_word.unpack_from(s, offset)[0]
     
-    def _read_signed_half_word(self, s):
+    def _read_signed_half_word(self, s, offset = 0):
     
-        return struct.unpack("<h", s)[0]
+        return self.signed_half_word.unpack_from(s, offset)[0]
     
     def _read(self, offset, length = 1):
     
         self.file.seek(offset, 0)
         return self.file.read(length)
     
-    def _write_unsigned_word(self, v):
+    def _read_buffer(self, offset, length):
+    
+        """Returns a bytearray containing the given number of bytes from the
+        offset given, padded with zeros if the file is too short, so that
+        values can be packed into it and the whole buffer written back."""
+        
+        buffer = bytearray(length)
+        data = self._read(offset, length)
+        buffer[:len(data)] = data
+        return buffer
+    
+    # Values are returned as strings unless a buffer is given, in which case
+    # they are packed into it at the offset given.
+    
+    def _write_unsigned_word(self, v, buffer = None, offset = 0):
+    
+        return self._pack(self.unsigned_word, v, buffer, offset)
+    
+    def _write_unsigned_half_word(self, v, buffer = None, offset = 0):
     
-        return struct.pack("<I", v)
+        return self._pack(self.unsigned_half_word, v, buffer, offset)
     
-    def _write_unsigned_half_word(self, v):
+    def _write_unsigned_byte(self, v, buffer = None, offset = 0):
     
-        return struct.pack("<H", v)
+        return self._pack(self.unsigned_byte, v, buffer, offset)
     
-    def _write_unsigned_byte(self, v):
+    def _pack(self, codec, v, buffer, offset):
     
-        return struct.pack("<B", v)
+        if buffer is None:
+            return codec.pack(v)
+        
+        codec.pack_into(buffer, offset, v)
     
     def _write(self, offset, data):
     
@@ -76,44 +113,30 @@ class Utilities:
     
     def _str2num(self, s):
     
-        i = 0
-        n = 0
-        while i < len(s):
-        
-            n = n | (s[i] << (i*8))
-            i = i + 1
+        codec = self.unsigned_codecs.get(len(s))
+        if codec is not None:
+            return codec.unpack(s)[0]
         
-        return n
+        return int.from_bytes(s, "little")
     
     def _num2str(self, size, n):
     
-        i = 0
-        s = ""
-        while i < size:
+        if size <= 0:
+            return b""
         
-            s += chr(n & 0xff)
-            n = n >> 8
-            i += 1
+        n = n & ((1 << (size * 8)) - 1)
+        codec = self.unsigned_codecs.get(size)
+        if codec is not None:
+            return codec.pack(n)
         
-        return s
+        return n.to_bytes(size, "little")
     
     def _binary(self, size, n):
     
-        new = ""
-        while (n != 0) & (size > 0):
+        if size <= 0:
+            return ""
         
-            if (n & 1)==1:
-                new = "1" + new
-            else:
-                new = "0" + new
-            
-            n = n >> 1
-            size = size - 1
-        
-        if size > 0:
-            new = ("0"*size) + new
-        
-        return new
+        return format(n & ((1 << size) - 1), "0%ib" % size)
     
     def _safe(self, s, with_space = 0):
     
@@ -0,0 +1,210 @@
+"""
+imageformat.py - Identify tape and disk images from their contents.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib, zlib
+
+# The formats that can be identified.
+UEF = "uef"
+GZIP_UEF = "uef.gz"
+SSD = "ssd"
+DSD = "dsd"
+DSD40 = "dsd40"
+ADFS = "adfs"
+
+# The makedfs.Disk formats used to read the DFS formats.
+dfs_formats = {SSD: None, DSD: "dsd", DSD40: "dsd40"}
+
+uef_magic = b"UEF File!\x00"
+
+# The number of bytes first read to examine the catalogues on both sides of a
+# double-sided DFS image, and the root directory of an ADFS image.
+header_length = 0xc00
+
+# Classifications of the images seen, keyed by the SHA-1 hash of the bytes
+# examined and the length of each image.
+_formats = {}
+
+def identify(path):
+
+    """Returns the format of the image at the given path, or None if the format
+    is not recognised. Only the start of the image is read."""
+
+    f = open(path, "rb")
+    try:
+        header = f.read(header_length)
+        
+        # Read the tracks needed to check for an unformatted second side.
+        length = dfs_header_length(header)
+        if length > len(header):
+            header += f.read(length - len(header))
+        
+        f.seek(0, 2)
+        size = f.tell()
+    finally:
+        f.close()
+
+    key = hashlib.sha1(header + str(size).encode("ascii")).digest()
+
+    try:
+        return _formats[key]
+    except KeyError:
+        format = _formats[key] = classify(header, size)
+        return format
+
+def classify(header, size):
+
+    """Returns the format of an image of the given size that starts with the
+    header given, or None if the format is not recognised."""
+
+    if header.startswith(uef_magic):
+        return UEF
+
+    if header.startswith(b"\x1f\x8b"):
+
+        # Only decompress enough of a gzip file to find the UEF header.
+        try:
+            data = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(header, len(uef_magic))
+        except zlib.error:
+            return None
+
+        if data == uef_magic:
+            return GZIP_UEF
+        else:
+            return None
+
+    # ADFS directories start and end with the same identifier, and the root
+    # directory follows the free space map.
+    if header[0x201:0x205] in (b"Hugo", b"Nick") and header[0x6fb:0x6ff] == header[0x201:0x205]:
+        return ADFS
+
+    sectors = dfs_sectors(header, 0)
+
+    # The catalogue of the second side of a double-sided image follows the
+    # first track of the first side.
+    other_sectors = dfs_sectors(header, 0xa00)
+
+    if sectors is None:
+
+        # Only the second side of a double-sided image may be formatted.
+        if other_sectors is not None and blank(header, 0) and size > other_sectors * 256:
+            return double_sided(other_sectors)
+
+        return None
+
+    if other_sectors is not None and (other_sectors == sectors or size > sectors * 256):
+        return double_sided(sectors)
+
+    # An image larger than one side whose second side is unformatted is also
+    # double-sided, but only if the tracks of the second side that would hold
+    # the files on the first side of a single-sided image are also blank.
+    if other_sectors is None and size > sectors * 256 and blank(header, 0xa00) and \
+       blank_tracks(header, (used_sectors(header, 0) + 9) // 10):
+        return double_sided(sectors)
+
+    return SSD
+
+def double_sided(sectors):
+
+    """Returns the format of a double-sided image with the given number of
+    sectors on each side."""
+
+    if sectors > 400:
+        return DSD
+    else:
+        return DSD40
+
+def blank(header, offset):
+
+    """Returns True if the catalogue sectors at the offset in the header given
+    contain a single repeated byte, as an unformatted side does."""
+
+    catalogue = header[offset:offset + 0x200]
+    return len(catalogue) == 0x200 and catalogue == catalogue[:1] * 0x200
+
+def blank_tracks(header, tracks):
+
+    """Returns True if the given number of tracks at the start of the second
+    side of a double-sided image in the header all contain the byte that fills
+    its first catalogue sector."""
+
+    filler = header[0xa00:0xa01]
+
+    for track in range(tracks):
+        start = (track * 2 + 1) * 0xa00
+        data = header[start:start + 0xa00]
+        if data != filler * len(data):
+            return False
+
+    return True
+
+def dfs_header_length(header):
+
+    """Returns the number of bytes needed to classify an image that starts with
+    the header given. This includes the interleaved tracks of the second side
+    of a double-sided image that would overlap the files on the first side."""
+
+    if dfs_sectors(header, 0) is None or dfs_sectors(header, 0xa00) is not None:
+        return header_length
+
+    tracks = (used_sectors(header, 0) + 9) // 10
+    return max(header_length, tracks * 2 * 0xa00)
+
+def used_sectors(header, offset):
+
+    """Returns the number of the sector following the last file in the valid
+    DFS catalogue at the offset in the header given."""
+
+    last_entry = header[offset + 0x105]
+    used = 2
+
+    for p in range(offset + 8, offset + last_entry + 8, 8):
+
+        extra = header[p + 0x106]
+        length = ((extra & 0x30) << 12) | (header[p + 0x105] << 8) | header[p + 0x104]
+        start = ((extra & 0x03) << 8) | header[p + 0x107]
+        used = max(used, start + (length + 255) // 256)
+
+    return used
+
+def dfs_sectors(header, offset):
+
+    """Returns the number of sectors given in the DFS catalogue at the offset
+    in the header given, or None if the catalogue is not valid."""
+
+    if len(header) < offset + 0x200:
+        return None
+
+    last_entry = header[offset + 0x105]
+    extra = header[offset + 0x106]
+    sectors = ((extra & 0x03) << 8) | header[offset + 0x107]
+
+    if last_entry % 8 != 0 or last_entry > 0xf8 or not 2 < sectors <= 800:
+        return None
+
+    for p in range(offset + 8, offset + last_entry + 8, 8):
+
+        # Names and directories must contain printable characters, and files
+        # must start after the catalogue.
+        for c in header[p:p + 8]:
+            if not 32 <= (c & 0x7f) < 127:
+                return None
+
+        start = ((header[p + 0x106] & 0x03) << 8) | header[p + 0x107]
+        if not 2 <= start < sectors:
+            return None
+
+    return sectors
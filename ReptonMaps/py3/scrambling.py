@@ -0,0 +1,103 @@
+"""
+scrambling.py - Scramble and unscramble game data using keystreams.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+class Keystream:
+
+    """keystream = Keystream(key)
+
+    Apply a repeating key to data by combining each byte with the
+    corresponding byte of the key using exclusive OR, so that the same
+    operation both scrambles and unscrambles the data.
+
+    The data and the key are converted to integers so that all the bytes are
+    combined in a single operation. The key is extended to the length of the
+    data and converted when data of each length is first seen at each
+    position in the key.
+    """
+
+    max_cached = 64
+
+    def __init__(self, key):
+
+        self.key = key
+        self.period = len(key)
+        self.values = {}
+
+    def _value(self, phase, length):
+
+        try:
+            return self.values[(phase, length)]
+        except KeyError:
+            pass
+
+        if len(self.values) >= self.max_cached:
+            self.values.clear()
+
+        repeats = (phase + length + self.period - 1) // self.period
+        key = (self.key * repeats)[phase:phase + length]
+
+        value = self.values[(phase, length)] = int.from_bytes(key, "big")
+        return value
+
+    def apply(self, data, offset = 0):
+
+        """Returns the result of applying the key to the data given, where the
+        first byte of the data is at the offset given in the keystream."""
+
+        length = len(data)
+        if length == 0:
+            return b""
+
+        value = int.from_bytes(data, "big") ^ self._value(offset % self.period, length)
+        return value.to_bytes(length, "big")
+
+    def stream(self, pieces, offset = 0):
+
+        """Generates the result of applying the key to each of the pieces of
+        data given in turn, where the first piece starts at the offset given
+        in the keystream. This allows data to be unscrambled as it is read,
+        or only partly unscrambled."""
+
+        for piece in pieces:
+            yield self.apply(piece, offset)
+            offset += len(piece)
+
+
+def _repton_key():
+
+    # Each block of 32 bytes uses the same pattern of offsets from a base
+    # value that is reduced by 32 for each block, starting again after 0.
+    o = [0x05, 0x04, 0x07, 0x06, 0x01, 0x00, 0x03, 0x02,
+         0x0d, 0x0c, 0x0f, 0x0e, 0x09, 0x08, 0x0b, 0x0a,
+         0x15, 0x14, 0x17, 0x16, 0x11, 0x10, 0x13, 0x12,
+         0x1d, 0x1c, 0x1f, 0x1e, 0x19, 0x18, 0x1b, 0x1a]
+
+    key = []
+    for v in range(0xe0, -1, -32):
+        key += [v + j for j in o]
+
+    return bytes(key)
+
+# Repton level and sprite data in certain releases. The first byte of the
+# data is not scrambled.
+repton = Keystream(_repton_key())
+
+# Dunjunz level data, using the low byte of each byte's offset.
+dunjunz = Keystream(bytes(range(256)))
+
+# Icarus level data, using the low byte of each byte's offset plus one.
+icarus = Keystream(bytes([(i + 1) % 256 for i in range(256)]))
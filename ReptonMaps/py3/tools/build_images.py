@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+"""
+build_images.py - A tool for building UEF and SSD images from a manifest.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+The manifest is a JSON or YAML file containing a list of images, or a
+dictionary with an "images" entry containing the list. Each image is a
+dictionary with the following entries:
+
+  output        the path of the image to create, ending in .uef, .ssd or .dsd
+  files         a list of files, each with "name", "load", "exec" and
+                "source" entries, and an optional "locked" entry for disks
+
+UEF images can also contain the following entries:
+
+  creator       the creator string to store in the file
+  gap           true if each file should be preceded by a gap
+  compresslevel the gzip compression level, or 0 for no compression
+
+Disk images can also contain the following entries:
+
+  title         the disk title
+  boot_option   the boot option
+  placement     the placement strategy for the files (see makedfs)
+  format        the disk format (see makedfs)
+  sides         for double-sided disks, a list of dictionaries containing
+                "title", "boot_option" and "files" entries for each side
+
+Addresses can be given as integers or as strings such as "0x1900". Source
+paths are relative to the directory containing the manifest.
+"""
+
+import hashlib, json, multiprocessing, os, sys, time
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+import UEFfile
+import makedfs
+from diskutils import DiskError, File
+
+def read_manifest(path):
+
+    text = open(path).read()
+
+    if path.endswith(".yaml") or path.endswith(".yml"):
+        if yaml is None:
+            raise ValueError("The yaml module is needed to read YAML manifests.")
+        manifest = yaml.safe_load(text)
+    else:
+        manifest = json.loads(text)
+
+    if type(manifest) == dict:
+        manifest = manifest["images"]
+
+    return manifest
+
+def number(value):
+
+    if type(value) == str:
+        return int(value, 0)
+    else:
+        return value
+
+def read_files(files, directory):
+
+    """Returns a list of (name, load, exec, data, locked) tuples for the list
+    of file dictionaries given."""
+
+    result = []
+
+    for file in files:
+
+        data = open(os.path.join(directory, file["source"]), "rb").read()
+        result.append((file["name"].encode("latin1"), number(file["load"]),
+                       number(file["exec"]), data, file.get("locked", False)))
+
+    return result
+
+def image_hash(image, directory):
+
+    """Returns a hash of the description of the image and the contents of the
+    files it contains."""
+
+    h = hashlib.sha1()
+    h.update(json.dumps(image, sort_keys = True).encode("utf8"))
+
+    sides = image.get("sides", [image])
+    for side in sides:
+        for file in side.get("files", []):
+            h.update(open(os.path.join(directory, file["source"]), "rb").read())
+
+    return h.hexdigest()
+
+def build_uef(image, directory):
+
+    uef = UEFfile.UEFfile(creator = image.get("creator", "build_images.py"))
+    files = read_files(image["files"], directory)
+
+    info = [(name, load, exec_, data) for name, load, exec_, data, locked in files]
+    uef.import_files(0, info, gap = image.get("gap", False))
+    uef.write(os.path.join(directory, image["output"]), write_emulator_info = False,
+              compresslevel = image.get("compresslevel", 9))
+
+def build_disk(image, directory):
+
+    disk = makedfs.Disk(image.get("format"))
+    disk.new()
+
+    sides = image.get("sides", [image])
+    for side in range(len(sides)):
+
+        catalogue = disk.catalogue(side)
+        catalogue.boot_option = sides[side].get("boot_option", 0)
+
+        files = []
+        for name, load, exec_, data, locked in read_files(sides[side]["files"], directory):
+            files.append(File(name, data, load, exec_, len(data), locked))
+
+        catalogue.write(sides[side].get("title", "").encode("latin1"), files,
+                        image.get("placement", "first"))
+
+    f = open(os.path.join(directory, image["output"]), "wb")
+    f.write(disk.file.getvalue())
+    f.close()
+
+def build_image(args):
+
+    """Builds the image described by the dictionary given, returning the
+    output path, the time taken and an error message, or None."""
+
+    image, directory = args
+    start = time.time()
+
+    try:
+        if image["output"].lower().endswith(".uef"):
+            build_uef(image, directory)
+        else:
+            build_disk(image, directory)
+        error = None
+
+    except (UEFfile.UEFfile_error, DiskError, IOError, KeyError, ValueError) as exception:
+        error = str(exception)
+
+    except Exception as exception:
+        # Report unexpected errors for this image without stopping the
+        # other workers.
+        error = "%s: %s" % (exception.__class__.__name__, exception)
+
+    return image["output"], time.time() - start, error
+
+
+if __name__ == "__main__":
+
+    if not 2 <= len(sys.argv) <= 3:
+
+        sys.stderr.write("Usage: %s <manifest file> [<processes>]\n" % sys.argv[0])
+        sys.exit(1)
+
+    manifest_path = sys.argv[1]
+    directory = os.path.dirname(os.path.abspath(manifest_path))
+
+    try:
+        if len(sys.argv) == 3:
+            processes = int(sys.argv[2])
+            if processes < 1:
+                raise ValueError
+        else:
+            processes = None
+
+    except ValueError:
+        sys.stderr.write("The number of processes must be a positive integer.\n")
+        sys.exit(1)
+
+    try:
+        images = read_manifest(manifest_path)
+    except (IOError, KeyError, ValueError) as exception:
+        sys.stderr.write("Failed to read the manifest: %s\n" % exception)
+        sys.exit(1)
+
+    # The hashes of the images built previously are stored next to the
+    # manifest.
+    state_path = manifest_path + ".state"
+    try:
+        state = json.load(open(state_path))
+    except (IOError, ValueError):
+        state = {}
+
+    pending = []
+    hashes = {}
+    errors = 0
+
+    for image in images:
+
+        output = image["output"]
+
+        try:
+            hashes[output] = image_hash(image, directory)
+        except IOError as exception:
+            sys.stderr.write("%s: %s\n" % (output, exception))
+            errors += 1
+            continue
+
+        if state.get(output) == hashes[output] and \
+           os.path.exists(os.path.join(directory, output)):
+            sys.stdout.write("%s: unchanged\n" % output)
+        else:
+            pending.append((image, directory))
+
+    start = time.time()
+    built = 0
+
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        for output, elapsed, error in pool.imap_unordered(build_image, pending):
+
+            if error is None:
+                state[output] = hashes[output]
+                built += 1
+                sys.stdout.write("%s: built in %.3f seconds\n" % (output, elapsed))
+            else:
+                errors += 1
+                state.pop(output, None)
+                sys.stderr.write("%s: %s\n" % (output, error))
+    finally:
+        pool.close()
+        pool.join()
+
+        f = open(state_path, "w")
+        json.dump(state, f, sort_keys = True, indent = 4)
+        f.close()
+
+    sys.stdout.write("Built %i of %i images (%i errors) in %.2f seconds.\n" % (
+        built, len(images), errors, time.time() - start))
+
+    if errors:
+        sys.exit(1)
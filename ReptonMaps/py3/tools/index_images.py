@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+"""
+index_images.py - A tool for indexing the files in collections of tape and
+disk images.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json, multiprocessing, os, sqlite3, sys, time, zlib
+
+import UEFfile
+import imageformat
+from diskutils import DiskError
+from imagecache import ImageCache
+
+def find_images(directory):
+
+    """Returns a dictionary mapping the paths of the images found in the
+    directory tree to their modification times."""
+
+    images = {}
+
+    for root, dirs, files in os.walk(directory):
+
+        for name in files:
+
+            if name.split(".")[-1].lower() in ImageCache.suffixes:
+                path = os.path.join(root, name)
+                images[path] = os.stat(path).st_mtime
+
+    return images
+
+def index_image(args):
+
+    """Returns the path, modification time, a list of member details and an
+    error message, or None, for the image with the path and modification time
+    given."""
+
+    path, mtime = args
+
+    try:
+        format = imageformat.identify(path)
+        if format not in ImageCache.readers:
+            return path, mtime, [], "Unknown image format"
+
+        files = ImageCache.readers[format](path, format)
+
+        # File data may only be read here, so errors in damaged images can
+        # occur while the members are examined.
+        members = []
+        for file in files:
+
+            data = bytes(file.data)
+            members.append({"name": file.name.decode("latin1"),
+                            "load": file.load_address,
+                            "exec": file.execution_address,
+                            "length": len(data),
+                            "crc": zlib.crc32(data) & 0xffffffff})
+
+    except (UEFfile.UEFfile_error, DiskError, IOError, ValueError) as exception:
+        return path, mtime, [], str(exception)
+
+    except Exception as exception:
+        # Record unexpected errors for this image without stopping the
+        # other workers.
+        return path, mtime, [], "%s: %s" % (exception.__class__.__name__, exception)
+
+    return path, mtime, members, None
+
+
+class JSONIndex:
+
+    """index = JSONIndex(path)
+
+    An index stored as JSON lines, each describing a member of an image, or
+    an image that could not be read.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.records = {}
+
+        if os.path.exists(path):
+
+            for line in open(path):
+
+                record = json.loads(line)
+                self.records.setdefault(record["image"], []).append(record)
+
+    def mtimes(self):
+
+        return dict(map(lambda item: (item[0], item[1][0]["mtime"]),
+                        self.records.items()))
+
+    def add(self, image, mtime, members, error):
+
+        records = []
+        for member in members:
+
+            record = {"image": image, "mtime": mtime}
+            record.update(member)
+            records.append(record)
+
+        if error is not None or not records:
+            records.append({"image": image, "mtime": mtime, "error": error})
+
+        self.records[image] = records
+
+    def remove(self, image):
+
+        del self.records[image]
+
+    def close(self):
+
+        # Write a new file and replace the old one so that an interrupted
+        # run leaves the previous index intact.
+        temp_path = self.path + ".new"
+        f = open(temp_path, "w")
+
+        for image in sorted(self.records.keys()):
+            for record in self.records[image]:
+                f.write(json.dumps(record, sort_keys = True) + "\n")
+
+        f.close()
+        os.rename(temp_path, self.path)
+
+
+class SQLiteIndex:
+
+    """index = SQLiteIndex(path)
+
+    An index stored in an SQLite database with images and members tables.
+    """
+
+    def __init__(self, path):
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "create table if not exists images "
+            "(image text primary key, mtime real, error text)")
+        self.connection.execute(
+            "create table if not exists members "
+            "(image text, name text, load integer, exec integer, "
+            "length integer, crc integer)")
+        self.connection.execute(
+            "create index if not exists members_image on members (image)")
+
+    def mtimes(self):
+
+        return dict(self.connection.execute("select image, mtime from images"))
+
+    def add(self, image, mtime, members, error):
+
+        self.remove(image)
+        self.connection.execute("insert into images values (?, ?, ?)",
+                                (image, mtime, error))
+        self.connection.executemany(
+            "insert into members values (?, ?, ?, ?, ?, ?)",
+            map(lambda member: (image, member["name"], member["load"],
+                                member["exec"], member["length"], member["crc"]),
+                members))
+
+    def remove(self, image):
+
+        self.connection.execute("delete from images where image = ?", (image,))
+        self.connection.execute("delete from members where image = ?", (image,))
+
+    def close(self):
+
+        self.connection.commit()
+        self.connection.close()
+
+
+if __name__ == "__main__":
+
+    if not 3 <= len(sys.argv) <= 4:
+
+        sys.stderr.write("Usage: %s <directory> <index file> [<processes>]\n\n" % sys.argv[0])
+        sys.stderr.write("The index is written as JSON lines unless the index file name ends\n"
+                         "with .db or .sqlite, in which case an SQLite database is used.\n")
+        sys.exit(1)
+
+    directory = sys.argv[1]
+    index_path = sys.argv[2]
+
+    try:
+        if len(sys.argv) == 4:
+            processes = int(sys.argv[3])
+            if processes < 1:
+                raise ValueError
+        else:
+            processes = None
+
+    except ValueError:
+        sys.stderr.write("The number of processes must be a positive integer.\n")
+        sys.exit(1)
+
+    if index_path.endswith(".db") or index_path.endswith(".sqlite"):
+        index = SQLiteIndex(index_path)
+    else:
+        index = JSONIndex(index_path)
+
+    # Only read images that are new or have changed since the last run, and
+    # forget images that have been removed.
+    images = find_images(directory)
+    indexed = index.mtimes()
+
+    for image in list(indexed.keys()):
+        if image not in images:
+            index.remove(image)
+
+    pending = []
+    for image, mtime in sorted(images.items()):
+        if indexed.get(image) != mtime:
+            pending.append((image, mtime))
+
+    start = time.time()
+    errors = 0
+
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        for image, mtime, members, error in pool.imap_unordered(index_image, pending, 16):
+
+            index.add(image, mtime, members, error)
+            if error is not None:
+                errors += 1
+                sys.stderr.write("%s: %s\n" % (image, error))
+    finally:
+        pool.close()
+        pool.join()
+        index.close()
+
+    elapsed = time.time() - start
+    if elapsed > 0:
+        rate = len(pending) / elapsed
+    else:
+        rate = 0
+
+    sys.stdout.write("Indexed %i of %i images (%i errors) in %.2f seconds, %.1f images/second.\n" % (
+        len(pending), len(images), errors, elapsed, rate))
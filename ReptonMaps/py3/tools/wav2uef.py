@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""
+wav2uef.py - A tool for converting cassette audio to UEF files.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys, time, wave
+
+import UEFfile
+from tapeaudio import read_wav
+
+if __name__ == "__main__":
+
+    if not 3 <= len(sys.argv) <= 4:
+    
+        sys.stderr.write("Usage: %s <WAV file> <UEF file> [<processes>]\n\n" % sys.argv[0])
+        sys.stderr.write("If more than one process is used, the recording is split at gaps and\n"
+                         "the pieces are decoded in parallel.\n")
+        sys.exit(1)
+    
+    wav_file = sys.argv[1]
+    uef_file = sys.argv[2]
+    
+    try:
+        if len(sys.argv) == 4:
+            processes = int(sys.argv[3])
+            if processes < 1:
+                raise ValueError
+        else:
+            processes = 1
+    
+    except ValueError:
+        sys.stderr.write("The number of processes must be a positive integer.\n")
+        sys.exit(1)
+    
+    try:
+        f = wave.open(wav_file, "rb")
+        duration = f.getnframes() / float(f.getframerate())
+        f.close()
+    except (IOError, wave.Error) as exception:
+        sys.stderr.write("%s\n" % exception)
+        sys.exit(1)
+    
+    start = time.time()
+    
+    uef = UEFfile.UEFfile(creator = "wav2uef.py")
+    uef.write(uef_file, write_emulator_info = False,
+              chunks = read_wav(wav_file, processes = processes))
+    
+    elapsed = time.time() - start
+    if elapsed > 0:
+        sys.stdout.write("Decoded %.1f seconds of audio in %.2f seconds (%.1f times real time).\n" % (
+            duration, elapsed, duration / elapsed))
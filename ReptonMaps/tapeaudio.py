@@ -0,0 +1,636 @@
+"""
+tapeaudio.py - Conversion between UEF chunks and cassette audio.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import audioop, math, multiprocessing, re, struct, wave
+from fractions import Fraction
+
+class Renderer:
+
+    """renderer = Renderer(sample_rate, amplitude, version)
+
+    Render the chunks of a UEF file as 16-bit mono PCM audio, using a low tone
+    (one cycle at the base frequency) for each zero bit and a high tone (two
+    cycles at twice the base frequency) for each one bit.
+
+    The version is the (major, minor) UEF version, which determines how 0x102
+    chunks are interpreted.
+
+    The samples for each bit are copied from tables which are created when a
+    bit is first rendered at each phase relative to the sample clock, and the
+    samples for common bytes and carrier tones are built from these, so the
+    audio is produced without calculating individual samples.
+    """
+
+    def __init__(self, sample_rate = 44100, amplitude = 0.5, version = (0, 10)):
+
+        self.sample_rate = sample_rate
+        self.amplitude = amplitude
+        self.major, self.minor = version
+        self.set_base_frequency(1200)
+
+        # The position in samples of the end of the audio rendered so far.
+        self.position = Fraction(0)
+
+        self.tables = {}
+
+    def set_base_frequency(self, frequency):
+
+        # The number of samples in each cycle of the high tone.
+        self.base_frequency = frequency
+        self.cycle = Fraction(self.sample_rate) / (2 * Fraction(frequency).limit_denominator(1000))
+
+    def samples(self, phase, cycles, length):
+
+        # Return the samples for the given number of sine wave cycles spread
+        # over the given number of high tone cycles, starting at the phase
+        # given, where the phase is the fractional part of the position.
+        end = phase + length * self.cycle
+        start = int(math.ceil(phase))
+
+        values = []
+        for i in range(start, int(math.ceil(end))):
+
+            t = (i - phase) / (length * self.cycle)
+            values.append(int(round(math.sin(2 * math.pi * cycles * t) * self.amplitude * 32767)))
+
+        return struct.pack("<%ih" % len(values), *values)
+
+    def bit(self, value, phase):
+
+        key = ("bit", self.cycle, value, phase)
+
+        try:
+            return self.tables[key]
+        except KeyError:
+            if value:
+                samples = self.samples(phase, 2, 2)
+            else:
+                samples = self.samples(phase, 1, 2)
+
+            self.tables[key] = samples
+            return samples
+
+    def bits(self, value, count):
+
+        # Render the given number of bits from the value given, starting with
+        # the least significant bit.
+        key = ("bits", self.cycle, value, count, self.position - int(self.position))
+
+        try:
+            samples = self.tables[key]
+            self.position += 2 * count * self.cycle
+
+        except KeyError:
+            pieces = []
+            for i in range(count):
+
+                phase = self.position - int(self.position)
+                pieces.append(self.bit((value >> i) & 1, phase))
+                self.position += 2 * self.cycle
+
+            samples = self.tables[key] = "".join(pieces)
+
+        return samples
+
+    def carrier(self, cycles):
+
+        # The samples for a number of cycles repeat when the number of samples
+        # they occupy is an integer.
+        period = self.cycle.denominator
+        phase = self.position - int(self.position)
+        key = ("carrier", self.cycle, phase)
+
+        try:
+            block = self.tables[key]
+        except KeyError:
+            block = self.tables[key] = self.samples(phase, period, period)
+
+        samples = block * (cycles / period)
+        self.position += (cycles - cycles % period) * self.cycle
+
+        remainder = cycles % period
+        if remainder:
+            key = ("carrier", self.cycle, phase, remainder)
+
+            try:
+                samples += self.tables[key]
+            except KeyError:
+                self.tables[key] = self.samples(phase, remainder, remainder)
+                samples += self.tables[key]
+
+            self.position += remainder * self.cycle
+
+        return samples
+
+    def gap(self, length):
+
+        # Render silence lasting the given number of samples.
+        start = int(math.ceil(self.position))
+        self.position += length
+        return "\x00\x00" * (int(math.ceil(self.position)) - start)
+
+    def render_chunk(self, chunk):
+
+        """Returns the samples for the chunk given as a string containing
+        16-bit little-endian values."""
+
+        chunk_id, data = chunk
+
+        if chunk_id == 0x100:
+
+            # Each byte is framed by a start bit and a stop bit.
+            return "".join(map(lambda c: self.bits((ord(c) << 1) | 0x200, 10), str(data)))
+
+        elif chunk_id == 0x102:
+
+            if self.major == 0 and self.minor < 9:
+                ignore = 0
+                data = str(data)
+            else:
+                ignore = ord(data[0])
+                data = str(data[1:])
+
+            count = max(0, len(data) * 8 - ignore)
+            pieces = map(lambda c: self.bits(ord(c), 8), data[:count / 8])
+
+            if count % 8:
+                pieces.append(self.bits(ord(data[count / 8]), count % 8))
+
+            return "".join(pieces)
+
+        elif chunk_id == 0x104:
+
+            # Data bits, parity and stop bits, followed by the data.
+            bits, parity, stop = struct.unpack("<BcB", data[:3])
+            pieces = []
+
+            for c in str(data[3:]):
+
+                value = ord(c) & ((1 << bits) - 1)
+                frame = value << 1
+                count = 1 + bits
+
+                if parity in "EO":
+                    ones = bin(value).count("1")
+                    frame |= ((ones + (parity == "O")) & 1) << count
+                    count += 1
+
+                frame |= ((1 << (stop & 0x7f)) - 1) << count
+                count += stop & 0x7f
+                pieces.append(self.bits(frame, count))
+
+            return "".join(pieces)
+
+        elif chunk_id == 0x110:
+
+            return self.carrier(struct.unpack("<H", data[:2])[0])
+
+        elif chunk_id == 0x111:
+
+            # Carrier tone with a dummy byte between two runs of carrier.
+            before, after = struct.unpack("<HH", data[:4])
+            return self.carrier(before) + self.bits((0xaa << 1) | 0x200, 10) + self.carrier(after)
+
+        elif chunk_id == 0x112:
+
+            return self.gap(struct.unpack("<H", data[:2])[0] * self.cycle)
+
+        elif chunk_id == 0x113:
+
+            self.set_base_frequency(struct.unpack("<f", data[:4])[0])
+            return ""
+
+        elif chunk_id == 0x116:
+
+            # Gaps given in seconds end on a sample boundary so that bits are
+            # only rendered at a limited number of phases.
+            length = Fraction(struct.unpack("<f", data[:4])[0]) * self.sample_rate
+            end = int(math.ceil(self.position + length))
+            return self.gap(end - self.position)
+
+        # Other chunks do not contain audio.
+        return ""
+
+    def render(self, chunks):
+
+        """Generates the samples for each of the chunks given in turn."""
+
+        for chunk in chunks:
+            yield self.render_chunk(chunk)
+
+    def write(self, chunks, path):
+
+        """Writes the audio for the chunks given to a WAV file with the given
+        path, rendering one chunk at a time."""
+
+        f = wave.open(path, "wb")
+        try:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(self.sample_rate)
+
+            for samples in self.render(chunks):
+                f.writeframes(samples)
+        finally:
+            f.close()
+
+
+def write_wav(uef, path, sample_rate = 44100):
+
+    """Writes the audio for the chunks in the UEFfile instance given to a WAV
+    file with the given path."""
+
+    renderer = Renderer(sample_rate, version = (uef.major, uef.minor))
+    renderer.write(uef.chunks, path)
+
+
+class Demodulator:
+
+    """demodulator = Demodulator(sample_rate, threshold, base_frequency)
+
+    Recover UEF chunks from cassette audio. Samples are passed to the feed
+    method as 8-bit signed values, and the chunks found are returned as lists
+    of (chunk ID, data) tuples: 0x100 chunks for runs of bytes, 0x110 chunks
+    for carrier tones and 0x112 chunks for gaps.
+
+    Each sample is classified as positive, negative or quiet, using the
+    threshold given as a fraction of full scale, by translating the samples
+    with a table, and the lengths of the runs of each kind of sample are
+    found with a regular expression. Only the half cycles between changes of
+    sign are examined individually.
+    """
+
+    runs = re.compile("\\++|-+| +")
+
+    def __init__(self, sample_rate, threshold = 0.05, base_frequency = 1200):
+
+        self.sample_rate = sample_rate
+        self.base_frequency = base_frequency
+
+        # Half cycles of the high tone and low tone are about one and two
+        # times this length.
+        half = sample_rate / (4.0 * base_frequency)
+        self.short_limit = 1.5 * half
+        self.long_limit = 3 * half
+
+        limit = int(threshold * 128)
+        table = []
+        for i in range(256):
+            if i < 128 and i >= limit:
+                table.append("+")
+            elif i >= 128 and i <= 256 - limit:
+                table.append("-")
+            else:
+                table.append(" ")
+
+        self.table = "".join(table)
+
+        # The current run of samples.
+        self.symbol = None
+        self.length = 0
+        self.position = 0
+
+        # The sign and position of the last change of sign, and the number of
+        # quiet samples since the last signal.
+        self.sign = None
+        self.crossing = 0
+        self.gap = 0
+
+        # The half cycles found for the current bit.
+        self.short = 0
+        self.long = 0
+
+        # The bits of the current byte, or None between bytes, the bytes in
+        # the current run of bytes and the number of cycles of carrier.
+        self.frame = None
+        self.bytes = []
+        self.carrier = 0
+
+        self.chunks = []
+
+    def feed(self, samples):
+
+        """Processes the string of 8-bit signed samples given, returning a
+        list of the chunks completed."""
+
+        for match in self.runs.finditer(samples.translate(self.table)):
+
+            symbol = match.group()[0]
+            length = match.end() - match.start()
+
+            if symbol == self.symbol:
+                self.length += length
+            else:
+                self.end_run()
+                self.symbol = symbol
+                self.length = length
+
+        chunks = self.chunks
+        self.chunks = []
+        return chunks
+
+    def finish(self):
+
+        """Processes any remaining samples and returns a list of the chunks
+        completed."""
+
+        self.end_run()
+        self.symbol = None
+        self.length = 0
+
+        # Count the last half cycle before the end of the recording.
+        if self.sign is not None:
+            self.half_cycle(self.position - self.crossing)
+
+        self.end_signal()
+
+        if self.gap:
+            self.add_gap()
+
+        chunks = self.chunks
+        self.chunks = []
+        return chunks
+
+    def end_run(self):
+
+        start = self.position
+        self.position += self.length
+
+        if self.symbol == " ":
+
+            # Long runs of quiet samples are gaps, and short runs occur when
+            # the signal crosses zero.
+            if self.length > self.long_limit * 2:
+                # Count the last half cycle before the signal stopped.
+                if self.sign is not None:
+                    self.half_cycle(start - self.crossing)
+                self.end_signal()
+                self.gap += self.length
+
+        elif self.symbol is not None:
+
+            if self.sign is None:
+
+                # The signal starts again after a gap.
+                if self.gap:
+                    self.add_gap()
+
+                self.sign = self.symbol
+                self.crossing = start
+
+            elif self.symbol != self.sign:
+
+                self.half_cycle(start - self.crossing)
+                self.sign = self.symbol
+                self.crossing = start
+
+    def end_signal(self):
+
+        # Discard any incomplete bit or byte and record any bytes or carrier
+        # found before the signal stopped.
+        self.sign = None
+        self.short = self.long = 0
+        self.frame = None
+        self.add_bytes()
+        self.add_carrier()
+
+    def half_cycle(self, length):
+
+        if length < self.short_limit:
+
+            # Two cycles of the high tone make a one bit.
+            self.long = 0
+            self.short += 1
+            if self.short == 4:
+                self.short = 0
+                self.bit(1)
+
+        elif length < self.long_limit:
+
+            # One cycle of the low tone makes a zero bit.
+            self.short = 0
+            self.long += 1
+            if self.long == 2:
+                self.long = 0
+                self.bit(0)
+        else:
+            self.end_signal()
+
+    def bit(self, value):
+
+        if self.frame is None:
+
+            if value == 1:
+                # Carrier tone between bytes.
+                self.add_bytes()
+                self.carrier += 2
+            else:
+                # A start bit.
+                self.add_carrier()
+                self.frame = []
+
+        else:
+            self.frame.append(value)
+
+            if len(self.frame) == 9:
+
+                # Only keep bytes with a valid stop bit.
+                if self.frame[8] == 1:
+                    byte = 0
+                    for i in range(8):
+                        byte |= self.frame[i] << i
+                    self.bytes.append(chr(byte))
+
+                self.frame = None
+
+    def add_bytes(self):
+
+        if self.bytes:
+            self.chunks.append((0x100, "".join(self.bytes)))
+            self.bytes = []
+
+    def add_carrier(self):
+
+        while self.carrier > 0:
+            cycles = min(self.carrier, 0xffff)
+            self.chunks.append((0x110, struct.pack("<H", cycles)))
+            self.carrier -= cycles
+
+    def add_gap(self):
+
+        # Gaps are measured in cycles of the high tone.
+        length = int(round(self.gap * 2.0 * self.base_frequency / self.sample_rate))
+        self.gap = 0
+
+        while length > 0:
+            n = min(length, 0xffff)
+            self.chunks.append((0x112, struct.pack("<H", n)))
+            length -= n
+
+
+def read_wav_samples(path, start = 0, end = None, block_size = 65536):
+
+    """Generates blocks of 8-bit signed samples from the frames between start
+    and end in the WAV file with the given path, returning the sample rate
+    and a generator."""
+
+    f = wave.open(path, "rb")
+    sample_rate = f.getframerate()
+
+    if end is None:
+        end = f.getnframes()
+
+    def blocks():
+
+        try:
+            width = f.getsampwidth()
+            channels = f.getnchannels()
+            f.setpos(start)
+            position = start
+
+            while position < end:
+
+                frames = f.readframes(min(block_size, end - position))
+                if not frames:
+                    break
+
+                position += len(frames) / (width * channels)
+
+                if width == 1:
+                    # 8-bit WAV files contain unsigned samples.
+                    frames = audioop.bias(frames, 1, -128)
+                if channels == 2:
+                    frames = audioop.tomono(frames, width, 0.5, 0.5)
+
+                yield audioop.lin2lin(frames, width, 1)
+        finally:
+            f.close()
+
+    return sample_rate, blocks()
+
+def demodulate(args):
+
+    """Returns a list of the chunks found in the frames between start and end
+    in the WAV file with the given path."""
+
+    path, start, end, threshold = args
+    sample_rate, blocks = read_wav_samples(path, start, end)
+    demodulator = Demodulator(sample_rate, threshold)
+
+    chunks = []
+    for samples in blocks:
+        chunks += demodulator.feed(samples)
+
+    return chunks + demodulator.finish()
+
+def find_gaps(path, minimum = 0.5, threshold = 0.05, block_size = 65536):
+
+    """Returns a list of frame positions in the middle of gaps lasting at least
+    the minimum number of seconds given in the WAV file with the given path."""
+
+    sample_rate, blocks = read_wav_samples(path, block_size = block_size)
+
+    # Measure the peak level of short windows, recording the middle of each
+    # run of quiet windows that is long enough.
+    window = max(1, sample_rate / 100)
+    limit = int(threshold * 128)
+    gaps = []
+    quiet = 0
+    position = 0
+    remainder = ""
+
+    for samples in blocks:
+
+        samples = remainder + samples
+        end = len(samples) - (len(samples) % window)
+        remainder = samples[end:]
+
+        for i in range(0, end, window):
+
+            if audioop.max(samples[i:i + window], 1) < limit:
+                quiet += window
+            else:
+                if quiet >= minimum * sample_rate:
+                    gaps.append(position - quiet / 2)
+                quiet = 0
+
+            position += window
+
+    return gaps
+
+def read_wav(path, threshold = 0.05, processes = 1, minimum_gap = 0.5):
+
+    """Generates the chunks found in the WAV file with the given path. If more
+    than one process is used, the recording is split at gaps and the pieces
+    are decoded in parallel."""
+
+    if processes == 1:
+
+        sample_rate, blocks = read_wav_samples(path)
+        demodulator = Demodulator(sample_rate, threshold)
+
+        for samples in blocks:
+            for chunk in demodulator.feed(samples):
+                yield chunk
+
+        for chunk in demodulator.finish():
+            yield chunk
+
+        return
+
+    # Split the recording into roughly equal pieces at gaps.
+    f = wave.open(path, "rb")
+    frames = f.getnframes()
+    f.close()
+
+    gaps = find_gaps(path, minimum_gap, threshold)
+    pieces = processes * 4
+    splits = []
+
+    for i in range(1, pieces):
+
+        target = frames * i / pieces
+        if gaps:
+            split = min(gaps, key = lambda gap: abs(gap - target))
+            if not splits or split > splits[-1]:
+                splits.append(split)
+
+    bounds = zip([0] + splits, splits + [frames])
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        last = None
+        for chunks in pool.imap(demodulate, map(lambda (start, end): (path, start, end, threshold), bounds)):
+
+            for chunk in chunks:
+
+                # Join the gaps at the ends of neighbouring pieces.
+                if last is not None and last[0] == 0x112 and chunk[0] == 0x112:
+                    length = struct.unpack("<H", last[1])[0] + struct.unpack("<H", chunk[1])[0]
+                    if length <= 0xffff:
+                        last = (0x112, struct.pack("<H", length))
+                        continue
+
+                if last is not None:
+                    yield last
+                last = chunk
+
+        if last is not None:
+            yield last
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""
+uef2wav.py - A tool for converting UEF files to cassette audio.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+
+import UEFfile
+from tapeaudio import write_wav
+
+if __name__ == "__main__":
+
+    if not 3 <= len(sys.argv) <= 4:
+    
+        sys.stderr.write("Usage: %s <UEF file> <WAV file> [<sample rate>]\n" % sys.argv[0])
+        sys.exit(1)
+    
+    uef_file = sys.argv[1]
+    wav_file = sys.argv[2]
+    
+    try:
+        if len(sys.argv) == 4:
+            sample_rate = int(sys.argv[3])
+            if sample_rate <= 0:
+                raise ValueError
+        else:
+            sample_rate = 44100
+    
+    except ValueError:
+        sys.stderr.write("The sample rate must be a positive integer.\n")
+        sys.exit(1)
+    
+    try:
+        uef = UEFfile.UEFfile(uef_file, lazy = True)
+    except UEFfile.UEFfile_error, exception:
+        sys.stderr.write("%s\n" % exception)
+        sys.exit(1)
+    
+    write_wav(uef, wav_file, sample_rate)